@@ -1,68 +1,225 @@
-from flask import Flask, request, jsonify
-from flask_cors import CORS
-from fido2.webauthn import PublicKeyCredentialRpEntity, PublicKeyCredentialUserEntity
-from fido2.server import Fido2Server
-from fido2.utils import websafe_decode, websafe_encode
+from flask import Flask, request, jsonify, g
+from fido2.webauthn import PublicKeyCredentialUserEntity
+from fido2.utils import websafe_encode
 from types import MappingProxyType
 import traceback
 import secrets
 import hashlib
 from fido2 import cbor
-from fido2.mds3 import MdsAttestationVerifier, parse_blob
-import requests as reqs
 from models import db, User, Credential, RecoveryCode 
+import stats
+import versioning
+import queries
+import db_engine
+import sessions
+import tenants
+import revocation
+from webauthn_parsing import ParsedRegistration, ParsedAssertion
+import capture
 from fido2.webauthn import AttestedCredentialData # build the credential data list from the database
 from fido2.cose import CoseKey
-import base64
-import redis
 import json
 import os
+import click
+from datetime import datetime
+import gzip
+import threading
+import time
+# brotli is optional, gzip is used when it is not installed
+try:
+    import brotli
+except ImportError:
+    brotli = None
 # Flask application setup
 # Reference: https://flask.palletsprojects.com/en/stable/quickstart/
 app = Flask(__name__)
 
+# Fast start mode, heavy modules and clients are created on first use or by
+# warm_up() in the background instead of at import time, and the schema is
+# left to the separate migrate command (python migrate.py)
+FAST_START = os.environ.get('FAST_START', '0') == '1'
+
+# lazily created clients, one lock each as the dev server is threaded
+# so a slow metadata download does not hold up the redis client
+# a factory that returns None is not cached, the next call tries again
+_lazy = {}
+_lazy_locks = {}
+
+def lazy_init(name, factory):
+    if name not in _lazy:
+        with _lazy_locks.setdefault(name, threading.Lock()):
+            if name not in _lazy:
+                value = factory()
+                if value is None:
+                    return None
+                _lazy[name] = value
+    return _lazy[name]
+
 # Redis connection for session & challenge storage
 # https://redis.io/docs/latest/develop/clients/redis-py/
-redis_client = redis.from_url(os.environ.get('REDIS_URL', 'redis://localhost:6379/0'))
+def get_redis():
+    def connect():
+        import redis
+        return redis.from_url(os.environ.get('REDIS_URL', 'redis://localhost:6379/0'))
+    return lazy_init("redis", connect)
 
 # https://flask-sqlalchemy.readthedocs.io/en/stable/config/#flask_sqlalchemy.config.SQLALCHEMY_DATABASE_URI
 app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'postgresql://localhost/passkeys_db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# pool sizing, pre-ping, recycle, statement cache and PgBouncer mode, see db_engine.py
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = db_engine.engine_options(app.config['SQLALCHEMY_DATABASE_URI'])
 app.config['SECRET_KEY'] = secrets.token_hex(32)
 
 # database Initialisation
 # https://flask-sqlalchemy.readthedocs.io/en/stable/quickstart/
+# init_app does not connect, the first query does
 db.init_app(app) 
-with app.app_context():
-    db.create_all()
-    
-# CORS (Cross-Origin Resource Sharing) configuration
-# Allows frontend on different port to communicate with backend
-# Reference: https://flask-cors.readthedocs.io/en/latest/
 
-ALLOWED_ORIGINS = [
-    "http://localhost:5173",
-    "https://localhost:5173",
-    "https://192.168.1.157:5173", 
-    "https://stephens-macbook-pro.local:5173",
+# changes create_all cannot make to tables that already exist, every step is idempotent and
+# runs in its own short transaction so a long running step does not hold the others' locks
+# https://www.postgresql.org/docs/current/sql-altertable.html
+SCHEMA_UPGRADES = [
+    # tenants (tenants.py), existing users belong to the default tenant
+    # a constant default only changes the catalog, the table is not rewritten
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS tenant_id VARCHAR(64) NOT NULL DEFAULT 'default'",
+]
+
+# built with CONCURRENTLY outside a transaction so reads and writes carry on during the build
+# an interrupted build leaves an INVALID index that IF NOT EXISTS skips, drop it and migrate again
+# https://www.postgresql.org/docs/current/sql-createindex.html#SQL-CREATEINDEX-CONCURRENTLY
+INDEX_UPGRADES = [
+    "CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS uq_users_tenant_username ON users (tenant_id, username)",
+    # bulk revocation (revocation.py), postgres does not index foreign key columns by itself
+    # and every cascaded delete looks the children up by user_id
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_credentials_user_id ON credentials (user_id)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_recovery_codes_user_id ON recovery_codes (user_id)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_credentials_aaguid ON credentials (aaguid)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_credentials_created_at ON credentials (created_at)",
+]
+
+# once the per-tenant unique index exists the global one can go
+POST_INDEX_UPGRADES = [
+    "ALTER TABLE users DROP CONSTRAINT IF EXISTS users_username_key",
+]
 
+# foreign keys turned into ON DELETE CASCADE for bulk revocation
+CASCADE_FOREIGN_KEYS = [
+    ("credentials", "user_id", "users (id)"),
+    ("recovery_codes", "user_id", "users (id)"),
 ]
-CORS(app, resources={r"/*": {"origins": ALLOWED_ORIGINS}}, supports_credentials=True)
 
+CONSTRAINT_QUERY = """
+    SELECT confdeltype, convalidated FROM pg_constraint
+    WHERE conname = :name AND conrelid = CAST(:table AS regclass)
+"""
+
+# the constraint is swapped with NOT VALID, which takes a brief ACCESS EXCLUSIVE lock without
+# checking any rows, and committed, then VALIDATE checks the existing rows in a separate
+# transaction under SHARE UPDATE EXCLUSIVE, which does not block inserts, updates or deletes
+# lock_timeout makes the swap give up rather than queue behind a long transaction and
+# block everything behind it, run migrate again if it does
+# https://www.postgresql.org/docs/current/sql-altertable.html#SQL-ALTERTABLE-NOTES
+def upgrade_foreign_key(table, column, references):
+    constraint = f"{table}_{column}_fkey"
+    with db.engine.begin() as conn:
+        conn.execute(db.text("SET LOCAL lock_timeout = '5s'"))
+        row = conn.execute(db.text(CONSTRAINT_QUERY), {"name": constraint, "table": table}).first()
+        if row is None or row.confdeltype != "c":
+            conn.execute(db.text(f"ALTER TABLE {table} DROP CONSTRAINT IF EXISTS {constraint}"))
+            conn.execute(db.text(
+                f"ALTER TABLE {table} ADD CONSTRAINT {constraint} "
+                f"FOREIGN KEY ({column}) REFERENCES {references} ON DELETE CASCADE NOT VALID"
+            ))
+            print(f"{constraint} is now ON DELETE CASCADE")
+
+    with db.engine.begin() as conn:
+        row = conn.execute(db.text(CONSTRAINT_QUERY), {"name": constraint, "table": table}).first()
+        if not row.convalidated:
+            conn.execute(db.text(f"ALTER TABLE {table} VALIDATE CONSTRAINT {constraint}"))
+            print(f"{constraint} validated")
+
+def upgrade_postgres():
+    with db.engine.begin() as conn:
+        for statement in SCHEMA_UPGRADES:
+            conn.execute(db.text(statement))
+    with db.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        for statement in INDEX_UPGRADES:
+            conn.execute(db.text(statement))
+    with db.engine.begin() as conn:
+        for statement in POST_INDEX_UPGRADES:
+            conn.execute(db.text(statement))
+    for table, column, references in CASCADE_FOREIGN_KEYS:
+        upgrade_foreign_key(table, column, references)
+
+# users created before tenants have tenant_id 'default', without a tenant of that id in
+# TENANTS_FILE they cannot sign in, existing_tenant hands them to the tenant that takes over
+def assign_existing_users(existing_tenant=None):
+    default_id = tenants.DEFAULT_TENANT
+    if existing_tenant and existing_tenant != default_id:
+        if TENANTS.get(existing_tenant) is None:
+            raise ValueError(f"tenant {existing_tenant} is not defined")
+        if TENANTS.get(default_id) is not None:
+            raise ValueError(f"tenant {default_id} is defined, its users cannot be moved to {existing_tenant}")
+        moved = db.session.query(User).filter(User.tenant_id == default_id).update(
+            {User.tenant_id: existing_tenant}, synchronize_session=False)
+        db.session.commit()
+        print(f"Moved {moved} users from {default_id} to {existing_tenant}")
+    elif TENANTS.get(default_id) is None and \
+            db.session.query(User.id).filter(User.tenant_id == default_id).first() is not None:
+        raise ValueError(f"users belong to tenant {default_id}, which is not defined, "
+                         f"add it to TENANTS_FILE or migrate with --existing-tenant")
+
+# schema creation, run once per deploy rather than on every import
+def migrate(existing_tenant=None):
+    with app.app_context():
+        db.create_all()
+        if db.engine.dialect.name == "postgresql":
+            upgrade_postgres()
+        assign_existing_users(existing_tenant)
+    print("Database schema is up to date")
+
+@app.cli.command("migrate")
+@click.option("--existing-tenant", help="tenant that takes over the users created before tenants")
+def migrate_command(existing_tenant):
+    migrate(existing_tenant)
+    
+# Relying parties served by this backend, see tenants.py
+# TENANTS_FILE holds the tenants (hot reloaded), without it the original single RP is used
+# https://www.w3.org/TR/webauthn-3/#relying-party
+TENANTS = tenants.TenantRegistry(os.environ.get('TENANTS_FILE'))
 
 
 @app.before_request
 def log_request():
     """Log incoming requests for debugging"""
+    g.request_started = time.perf_counter()
     print("INCOMING:", request.method, request.path)
 
+# every request belongs to the tenant its Origin (or Host) maps to
+# https://developer.mozilla.org/en-US/docs/Web/HTTP/Status/421
+@app.before_request
+def resolve_tenant():
+    g.tenant = TENANTS.resolve(request.headers.get('Origin'), request.host)
+    if g.tenant is None:
+        return jsonify({"error": f"no tenant is configured for {request.host}"}), 421
+
+def current_tenant():
+    return g.tenant
+
+# the current tenant's view of redis, every key gets the tenant prefix
+def tenant_redis():
+    return current_tenant().redis(get_redis())
+
 # load the fido mds 
 # https://stackoverflow.com/questions/26106702/how-do-i-parse-a-json-response-from-python-requests
 def load_mds():
     try:
+        # imported here, fido2.mds3 and requests are only needed for the metadata download
+        from fido2.mds3 import MdsAttestationVerifier, parse_blob
+        import requests as reqs
         with open("globalsign_root_ca.pem", "rb") as f:
             trust_root_bytes = f.read()
-        response = reqs.get("https://mds3.fidoalliance.org/")
+        response = reqs.get("https://mds3.fidoalliance.org/", timeout=10)
         if response.ok:
             mds = parse_blob(response.content, trust_root_bytes)
             print(f"Loaded fido mds no. times: {len(mds)}")
@@ -75,44 +232,206 @@ def load_mds():
 def after_request(response):
     #Ensure CORS headers are set on all responses
     #https://developer.mozilla.org/en-US/docs/Web/HTTP/CORS
+    # the origin was matched against the tenant's origin set when the tenant was resolved
     origin = request.headers.get('Origin')
-    if origin in ALLOWED_ORIGINS:
+    tenant = g.get('tenant')
+    if origin and tenant and origin in tenant.origins:
         response.headers['Access-Control-Allow-Origin'] = origin
+        response.headers['Access-Control-Allow-Credentials'] = 'true'
+    response.vary.add('Origin')
     response.headers['Access-Control-Allow-Headers'] = 'Content-Type,Authorization'
     response.headers['Access-Control-Allow-Methods'] = 'GET,POST,OPTIONS,DELETE'
+    # browsers reuse the preflight answer instead of sending OPTIONS before every call
+    # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Access-Control-Max-Age
+    response.headers['Access-Control-Max-Age'] = '600'
+    response.headers['Access-Control-Expose-Headers'] = 'ETag,Server-Timing'
+    # time spent in the app, read by benchmarks/replay.py
+    # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Server-Timing
+    if 'request_started' in g:
+        response.headers['Server-Timing'] = f"app;dur={(time.perf_counter() - g.request_started) * 1000:.3f}"
+    return response
+
+# compress large admin payloads
+# https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Content-Encoding
+COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))
+COMPRESS_ENCODINGS = ["br", "gzip"] if brotli else ["gzip"]
+
+@app.after_request
+def compress_response(response):
+    if (os.environ.get('COMPRESS_RESPONSES', '1') != '1'
+            or not request.path.startswith('/admin/')
+            or response.status_code != 200
+            or response.direct_passthrough
+            or 'Content-Encoding' in response.headers):
+        return response
+    
+    response.vary.add('Accept-Encoding')
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_SIZE:
+        return response
+    encoding = request.accept_encodings.best_match(COMPRESS_ENCODINGS)
+    if not encoding:
+        return response
+    
+    if encoding == "br":
+        response.set_data(brotli.compress(data))
+    else:
+        response.set_data(gzip.compress(data, compresslevel=6))
+    response.headers['Content-Encoding'] = encoding
+    # a strong ETag must differ between the encoded representations
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag(f"{etag}-{encoding}", weak)
     return response
 
-mds_verifier = load_mds()
+# traffic capture for replay benchmarks (benchmarks/replay.py)
+# registered after the other hooks so it sees the response before compression
+if os.environ.get('CAPTURE_FILE'):
+    capture.install(app, os.environ['CAPTURE_FILE'], os.environ.get('CAPTURE_SALT'))
+
+# conditional GET, answers If-None-Match with 304 before the database is queried
+# https://developer.mozilla.org/en-US/docs/Web/HTTP/Status/304
+def conditional_response(scope, build, username=None):
+    try:
+        etag = versioning.make_etag(tenant_redis(), scope, username)
+    except Exception as e:
+        # without redis there are no versions, just serve the full response
+        print(f"Error building etag for {scope}: {e}")
+        return build()
+    
+    # the 304 carries the validator the client matched, which is the encoded
+    # variant's ETag when the cached copy was compressed
+    # https://www.rfc-editor.org/rfc/rfc9110#section-15.4.5
+    variants = [etag] + [f"{etag}-{encoding}" for encoding in COMPRESS_ENCODINGS]
+    matched = next((tag for tag in variants if request.if_none_match.contains(tag)), None)
+    if matched:
+        response = app.response_class(status=304)
+        response.set_etag(matched)
+        response.vary.add('Accept-Encoding')
+        return response
+    
+    response = app.make_response(build())
+    if response.status_code == 200:
+        response.set_etag(etag)
+    return response
+
+# a failed download is retried on use, at most once every MDS_RETRY_INTERVAL seconds
+# so registrations do not each wait for the metadata service while it is down
+MDS_RETRY_INTERVAL = float(os.environ.get('MDS_RETRY_INTERVAL', 60))
+_mds_failed_at = None
+
+def get_mds_verifier():
+    global _mds_failed_at
+    if "mds_verifier" not in _lazy and _mds_failed_at is not None \
+            and time.monotonic() - _mds_failed_at < MDS_RETRY_INTERVAL:
+        return None
+    verifier = lazy_init("mds_verifier", load_mds)
+    _mds_failed_at = None if verifier else time.monotonic()
+    return verifier
 
 # FIDO2 WebAuthn Server Setup
 # https://github.com/Yubico/python-fido2
 #https://developers.yubico.com/python-fido2/
-rp = PublicKeyCredentialRpEntity(
-    id="stephens-macbook-pro.local",
-    name="Passwordless authentication"
-)
+# one Fido2Server per tenant, built on first use and cached by the registry
+def get_server():
+    return current_tenant().server()
+
+# warm-up hook, creates everything that would otherwise be built on the first request
+# run in a background thread in fast start mode so the port opens straight away
+# returns whether it succeeded
+WARM = threading.Event()
+
+def warm_up():
+    started = time.perf_counter()
+    try:
+        for tenant in TENANTS.all():
+            tenant.server()
+        get_redis().ping()
+        # missing metadata does not fail the warm-up, only "enforce" registrations need it
+        get_mds_verifier()
+        with app.app_context():
+            db.session.execute(db.text("SELECT 1"))
+            for tenant in TENANTS.all():
+                stats.ensure_stats(tenant.redis(get_redis()), tenant.id)
+            db.session.remove()
+        WARM.set()
+        print(f"Warm-up finished in {(time.perf_counter() - started) * 1000:.0f} ms")
+        return True
+    except Exception as e:
+        print(f"Error during warm-up: {e}")
+        return False
+
+# keeps retrying with exponential backoff until postgres and redis can be reached,
+# so a dependency that comes up after the app does not leave it unready for good
+WARM_UP_MAX_DELAY = float(os.environ.get('WARM_UP_MAX_DELAY', 30))
+_warm_up_lock = threading.Lock()
+_warm_up_thread = None
+
+def warm_up_with_retry():
+    delay = 0.5
+    while not warm_up():
+        print(f"Retrying warm-up in {delay:.1f} s")
+        time.sleep(delay)
+        delay = min(delay * 2, WARM_UP_MAX_DELAY)
+
+# starts the background warm-up unless it has finished or is already running
+# called at startup in fast start mode and by /health/ready, which also covers
+# flask run and WSGI servers where the __main__ block does not run
+def start_warm_up():
+    global _warm_up_thread
+    with _warm_up_lock:
+        if WARM.is_set() or (_warm_up_thread and _warm_up_thread.is_alive()):
+            return
+        _warm_up_thread = threading.Thread(target=warm_up_with_retry, daemon=True)
+        _warm_up_thread.start()
 
-server = Fido2Server(rp, attestation="direct")
 # Temporary in-memory storage for users using dictionary
 USERS = {}
 
+# where challenge states live between start and finish
+# "redis" stores them server side, "stateless" seals them into a token the client sends back
+# so the start endpoints do not write to redis at all (see challenge_tokens.py)
+CHALLENGE_MODE = os.environ.get('CHALLENGE_MODE', 'redis')
+
 # https://redis.io/docs/latest/commands/setex/
 # store the challenge state in redis 
+# returns the challenge token in stateless mode, None otherwise
+# tokens are bound to the tenant as well as the key, so one cannot be used on another tenant
 def store_challenge_state(key, state_data):
+    if CHALLENGE_MODE == "stateless":
+        import challenge_tokens
+        return challenge_tokens.issue(current_tenant().prefix + key, serialize_options(state_data))
     serialised = json.dumps(serialize_options(state_data))
-    redis_client.setex(f"webauthn_state:{key}", 300, serialised)
+    tenant_redis().setex(f"webauthn_state:{key}", 300, serialised)
+    return None
     
 # get the challenge state from redis
+# in stateless mode the token from the request body is opened and marked as used
 def get_challenge_state(key):
-    challenge_state = redis_client.get(f"webauthn_state:{key}")
+    if CHALLENGE_MODE == "stateless":
+        import challenge_tokens
+        token = request.json.get("challenge_token")
+        if not token:
+            return None
+        return challenge_tokens.consume(tenant_redis(), current_tenant().prefix + key, token)
+    challenge_state = tenant_redis().get(f"webauthn_state:{key}")
     if challenge_state:
         return json.loads(challenge_state)
     else:
         return None
     
 # delete the challenge state after expiry
+# stateless tokens were already consumed by get_challenge_state
 def delete_state(key):
-    redis_client.delete(f"webauthn_state:{key}")
+    if CHALLENGE_MODE == "stateless":
+        return
+    tenant_redis().delete(f"webauthn_state:{key}")
+
+# adds the challenge token (if any) to a start endpoint response
+def with_challenge_token(response_dict, token):
+    if token:
+        response_dict["challenge_token"] = token
+    return response_dict
 
 
 @app.get("/")
@@ -120,6 +439,38 @@ def root():
     """Health check endpoint"""
     return {"message": "backend is running"}
 
+# liveness, the process is up and serving requests
+# https://kubernetes.io/docs/tasks/configure-pod-container/configure-liveness-readiness-startup-probes/
+@app.get("/health/live")
+def health_live():
+    return {"status": "alive"}
+
+# readiness, warm-up has finished and postgres and redis can be reached
+@app.get("/health/ready")
+def health_ready():
+    if not WARM.is_set():
+        start_warm_up()
+    checks = {"warm": WARM.is_set()}
+    try:
+        db.session.execute(db.text("SELECT 1"))
+        checks["database"] = True
+    except Exception as e:
+        print(f"Readiness database check failed: {e}")
+        checks["database"] = False
+    try:
+        checks["redis"] = bool(get_redis().ping())
+    except Exception as e:
+        print(f"Readiness redis check failed: {e}")
+        checks["redis"] = False
+    
+    ready = all(checks.values())
+    return jsonify({"status": "ready" if ready else "not ready", "checks": checks}), 200 if ready else 503
+
+# connection pool metrics, in use / overflow counts and checkout wait times
+@app.get("/metrics/db")
+def db_metrics():
+    return jsonify(db_engine.pool_metrics(db.engine))
+
 
 # Convert fido2 options object to JSON-serializable dictionary.
     
@@ -183,7 +534,7 @@ def register_start():
 
         # Generate registration options and state
         # https://developers.yubico.com/python-fido2/API_Documentation/fido2.server.html
-        options, state = server.register_begin(
+        options, state = get_server().register_begin(
             user,
             credentials=[],
             user_verification="preferred",
@@ -194,12 +545,12 @@ def register_start():
         # Store user and state for the completion step
         USERS[username] = user
         # STATES[username] = state
-        store_challenge_state(username, state)
+        token = store_challenge_state(username, state)
 
         # Serialize options for JSON response
         options_dict = serialize_options(options)
         print("OPTIONS DICT:", options_dict)
-        return jsonify(options_dict)
+        return jsonify(with_challenge_token(options_dict, token))
     except Exception as e:
         print(f"ERROR in register_start: {e}")
         traceback.print_exc()
@@ -253,56 +604,55 @@ def register_finish():
         username = request.json["username"]
         credential = request.json["credential"]
         
+        # "enforce" tenants cannot register without the FIDO metadata, checked before the
+        # challenge is used up so the client can retry once the metadata has loaded
+        tenant = current_tenant()
+        mds_verifier = get_mds_verifier() if tenant.mds != "off" else None
+        if tenant.mds == "enforce" and mds_verifier is None:
+            return jsonify({"error": "FIDO metadata is not available, try again later"}), 503
+        
         state = get_challenge_state(username)
         if not state:
             return jsonify({"error": "Registration session expired"}), 400
         
         print(f"Credential received: {credential}")
         
-        # Structure the response to match fido2 RegistrationResponse format
-        #https://github.com/Yubico/python-fido2/blob/main/fido2/webauthn.py
-        registration_response = {
-            "id": credential["id"],
-            "rawId": credential["rawId"],
-            "response": {
-                "clientDataJSON": credential["response"]["clientDataJSON"],
-                "attestationObject": credential["response"]["attestationObject"],
-            },
-            "type": credential["type"],
-            "clientExtensionResults": credential.get("clientExtensionResults", {}),
-        }
+        # Decode the attestation object once into fido2 RegistrationResponse types
+        # https://github.com/Yubico/python-fido2/blob/main/fido2/webauthn.py
+        parsed = ParsedRegistration(credential)
         
         # Verify the registration response and extract credential data
         # check if mds is verified
         # https://github.com/Yubico/python-fido2/blob/main/examples/verify_attestation_mds3.py
-        auth_data = server.register_complete(
+        auth_data = get_server().register_complete(
             state,
-            registration_response,
-            # verify_attestation = mds_verifier,
+            parsed.response,
         )
-        mds_verified = bool(mds_verifier)
+        # the check Fido2Server makes when given verify_attestation, done here so the
+        # tenant's server (used by every ceremony) does not depend on the metadata
+        if tenant.mds == "enforce" and tenant.attestation != "none":
+            attestation = parsed.response.response
+            mds_verifier(attestation.attestation_object, attestation.client_data.hash)
+        mds_verified = mds_verifier is not None
         delete_state(username)
         
-        backup_eligible, backup_state = is_backup_eligible(auth_data)
+        backup_eligible, backup_state = is_backup_eligible(parsed.auth_data)
         
-        # extract attestation information using cbor 
-        attestation_obj = cbor.decode(websafe_decode(credential["response"]["attestationObject"]))
-        attestation_fmt = attestation_obj.get("fmt", "none")
-        
-        # get the authenticator attestation GUID
-        aaguid = auth_data.credential_data.aaguid.hex() if auth_data.credential_data.aaguid else "unknown"
+        # attestation format and authenticator attestation GUID from the parsed attestation object
+        attestation_fmt = parsed.fmt
+        aaguid = parsed.aaguid
             
         trust_level = attestation_trust_levels(attestation_fmt)
         print(f"AAGUID: {aaguid}")
         
         # https://www.geeksforgeeks.org/python/sqlalchemy-db-session-query/
-        user = User.query.filter_by(username=username).first()
+        user = queries.user_by_username(username, current_tenant().id)
         
     
         is_new_usr = user is None
         
         if is_new_usr:
-            user = User(username=username)
+            user = User(tenant_id=current_tenant().id, username=username)
             db.session.add(user)
             db.session.flush() # get the user id
             
@@ -320,6 +670,7 @@ def register_finish():
             mds_verified=mds_verified
         )
         db.session.add(new_cred)
+        stat_fields = stats.credential_fields(new_cred)
             
         
         recovery_codes = None
@@ -332,6 +683,8 @@ def register_finish():
                 db.session.add(recovery_code)
                 
         db.session.commit()
+        stats.credential_added(tenant_redis(), stat_fields, new_user=is_new_usr)
+        versioning.bump(tenant_redis(), username)
             
         print(f"User {username} registered successfully!")
         
@@ -357,7 +710,7 @@ def login_start():
     try:
         # https://www.geeksforgeeks.org/python/sqlalchemy-db-session-query/
         username = request.json["username"]
-        user = User.query.filter_by(username=username).first()
+        user = queries.user_by_username(username, current_tenant().id)
         if not user or not user.credentials:
             return {"error": "user is not registered"}, 404
         
@@ -376,14 +729,14 @@ def login_start():
             cred_data_list.append(cred_data)
         # Generate authentication options with allowed credentials
         # https://www.w3.org/TR/webauthn-2/#dictdef-publickeycredentialrequestoptions
-        options, state = server.authenticate_begin(
+        options, state = get_server().authenticate_begin(
             cred_data_list,
             user_verification="preferred",
         )
-        store_challenge_state(username, state)
+        token = store_challenge_state(username, state)
         
         options_dict = serialize_options(options)
-        return jsonify(options_dict)
+        return jsonify(with_challenge_token(options_dict, token))
     except Exception as e:
         print(f"ERROR in login_start: {e}")
         traceback.print_exc()
@@ -402,7 +755,7 @@ def login_finish():
     try:
         username = request.json["username"]
         credential = request.json["credential"]
-        user = User.query.filter_by(username=username).first()
+        user = queries.user_by_username(username, current_tenant().id)
         if not user:
             return {"error": "user not found"}, 404
         
@@ -413,19 +766,9 @@ def login_finish():
         
         print(f"Login credential received: {credential}")
         
-        # Structure the response to match fido2 AuthenticationResponse format
+        # Decode the assertion once into fido2 AuthenticationResponse types
         # https://github.com/Yubico/python-fido2/blob/main/fido2/webauthn.py
-        authentication_response = {
-            "id": credential["id"],
-            "rawId": credential["rawId"],
-            "response": {
-                "clientDataJSON": credential["response"]["clientDataJSON"],
-                "authenticatorData": credential["response"]["authenticatorData"],
-                "signature": credential["response"]["signature"],
-            },
-            "type": credential["type"],
-            "clientExtensionResults": credential.get("clientExtensionResults", {}),
-        }
+        parsed = ParsedAssertion(credential)
         
         # cred_data_list = [crd.credential_data for crd in creds]
         cred_data_list = []
@@ -444,20 +787,17 @@ def login_finish():
             
         
         # Verify the authentication response
-        result = server.authenticate_complete(
+        result = get_server().authenticate_complete(
             state,
             cred_data_list,
-            authentication_response,
+            parsed.response,
         )
         
-        # Extract sign count from authenticator data
-        auth_data_bytes = websafe_decode(credential["response"]["authenticatorData"])
-        # The sign count is a 32-bit unsigned integer located at bytes 33-36 of the authenticator data
-        new_sign_count = int.from_bytes(auth_data_bytes[33:37], byteorder='big')
+        # sign count from the already parsed authenticator data
+        new_sign_count = parsed.counter
 
-        credential_id_bytes = websafe_decode(credential["rawId"])
         for cred in user.credentials:
-            if cred.credential_id == credential_id_bytes:
+            if cred.credential_id == parsed.credential_id:
                 if new_sign_count <= cred.sign_count and cred.sign_count > 0:
                     print(f"WARNING: Possible cloned authenticator for {username}")
                     return jsonify({"error": "Authenticator may be cloned"}), 401
@@ -466,7 +806,7 @@ def login_finish():
                 break
         
         print(f"User {username} authenticated successfully!")
-        return {"status": "authenticated"}
+        return jsonify({"status": "authenticated", **sessions.issue_session(tenant_redis(), username, current_tenant().rp_id)})
     except Exception as e:
         db.session.rollback()
         print(f"ERROR in login_finish: {e}")
@@ -475,7 +815,7 @@ def login_finish():
 
 # user query function to get all users and their credential count, used in admin endpoint
 def user_query():
-    users = User.query.all()
+    users = User.query.filter_by(tenant_id=current_tenant().id).all()
     users_list = []
     for usr in users:
         users_list.append({
@@ -489,7 +829,7 @@ def user_query():
 @app.route("/admin/users", methods=["GET"])
 def get_users():    
     try:
-        return user_query()
+        return conditional_response("admin_users", user_query)
     except Exception as e:
         print(f"Error in get_users endpoint", {e})
         traceback.print_exc()
@@ -500,13 +840,11 @@ def get_users():
 def revoke_credentials():    
     try:
         usr = request.json["username"]
-        user = User.query.filter_by(username=usr).first()
-        if not user:
+        # same set-based path as the bulk endpoint, the database cascades to the credentials
+        result = revocation.revoke_users(tenant_redis(), current_tenant().id, [usr])
+        if not result["users"]:
             return jsonify({"ERROR" : f"{usr} was not found"}), 404
         
-        db.session.delete(user)
-        db.session.commit()
-        
         return jsonify({"status": "revoked", "username": usr})
     
     except Exception as e:
@@ -516,27 +854,65 @@ def revoke_credentials():
         return jsonify({"error": str(e)}), 500
 
 
+# bulk revocation for incident response, see revocation.py
+# {"usernames": [...]} removes accounts,
+# {"aaguid": ..., "registered_from": ..., "registered_to": ...} removes matching credentials
+# (any of the three, dates in ISO 8601), the response has the counts
+@app.route("/admin/revoke/bulk", methods=["POST"])
+def revoke_bulk():
+    try:
+        body = request.json
+        tenant = current_tenant()
+        date_filters = {key: datetime.fromisoformat(body[key]) for key in ("registered_from", "registered_to") if body.get(key)}
+        
+        if body.get("usernames") is not None:
+            if body.get("aaguid") or date_filters:
+                return jsonify({"error": "usernames cannot be combined with aaguid or dates"}), 400
+            # anything but a list of strings is a ValueError, answered with 400 below
+            result = revocation.revoke_users(tenant_redis(), tenant.id, body["usernames"])
+        else:
+            result = revocation.revoke_credentials(tenant_redis(), tenant.id, aaguid=body.get("aaguid"), **date_filters)
+        
+        print(f"Bulk revocation for {tenant.id}: {result}")
+        return jsonify({"status": "revoked", **result})
+    
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error in revoke_bulk: {e}")
+        traceback.print_exc()
+        return jsonify({"error": str(e)}), 500
+
+
 # get user passkeys endpoint
-@app.route("/user/passkeys", methods=["POST"])
+# GET ?username= supports conditional requests, POST is kept for older clients
+@app.route("/user/passkeys", methods=["GET", "POST"])
 def get_user_passkeys(): 
+    usr = None
     try:
-        usr = request.json["username"]
-        user = User.query.filter_by(username=usr).first()
+        usr = request.args["username"] if request.method == "GET" else request.json["username"]
         
-        if not user:
-            return jsonify({"error": f"{usr} not found"}), 404
+        def build():
+            user = queries.user_by_username(usr, current_tenant().id)
+            
+            if not user:
+                return jsonify({"error": f"{usr} not found"}), 404
 
+            
+            passkeys = []
+            # append all user specific passkeys 
+            for cred in user.credentials:
+                passkeys.append({
+                    "id" : cred.id,
+                    "credential_id" : cred.credential_id.hex(),
+                    "authenticator_type": cred.authenticator_type,
+                    "registered_at": cred.created_at.strftime("%Y-%m-%d %H:%M")  
+                })
+            return jsonify({"passkeys" : passkeys})
         
-        passkeys = []
-        # append all user specific passkeys 
-        for cred in user.credentials:
-            passkeys.append({
-                "id" : cred.id,
-                "credential_id" : cred.credential_id.hex(),
-                "authenticator_type": cred.authenticator_type,
-                "registered_at": cred.created_at.strftime("%Y-%m-%d %H:%M")  
-            })
-        return jsonify({"passkeys" : passkeys})
+        return conditional_response("user_passkeys", build, username=usr)
         
     except Exception as e:
         print(f"Error in get_user_passkeys for {usr}")
@@ -548,12 +924,12 @@ def get_user_passkeys():
 def delete_user_passkey(passkey_id):
     try:
         usr = request.json["username"]
-        user = User.query.filter_by(username=usr).first()
+        user = queries.user_by_username(usr, current_tenant().id)
         
         if not user:
             return jsonify({f"Error {usr} not found"}), 404
         
-        cred_to_delete = Credential.query.filter_by(id = passkey_id, user_id = user.id).first()
+        cred_to_delete = queries.credential_for_user(passkey_id, user.id)
         if not cred_to_delete:
              return jsonify({"error": "Passkey not found"}), 404
         
@@ -562,8 +938,11 @@ def delete_user_passkey(passkey_id):
         if len(user.credentials) == 1:
             return jsonify({"Error cannot delete last passkey, register another device first!"}), 404
         
+        stat_fields = stats.credential_fields(cred_to_delete)
         db.session.delete(cred_to_delete)
         db.session.commit()
+        stats.credential_removed(tenant_redis(), stat_fields)
+        versioning.bump(tenant_redis(), usr)
         
         # remove the credential 
         # CREDENTIALS[usr].pop(passkey_id)
@@ -582,16 +961,16 @@ def delete_user_passkey(passkey_id):
 @app.route("/login/start/usernameless", methods=["POST"])
 def login_start_usernameless():
     try:
-        options, state = server.authenticate_begin(
+        options, state = get_server().authenticate_begin(
             credentials = [], # empty for browser to show available passkeys
             user_verification='required',       
         )
         
         #states are stored using temporary keys
         # STATES["_usernameless_"] = state 
-        store_challenge_state("_usernameless_", state)
+        token = store_challenge_state("_usernameless_", state)
         opt_dict = serialize_options(options) 
-        return jsonify(opt_dict)
+        return jsonify(with_challenge_token(opt_dict, token))
     
     except Exception as e:
         print(f"Error in login_start_usernameless")
@@ -606,20 +985,20 @@ def login_finish_usernameless():
         print(f"Cred recieved: {cred}")
         
         
-        usr_handle = cred["response"].get("userHandle")
-        if not usr_handle:
+        # decode the assertion once, including the base64url userHandle
+        parsed = ParsedAssertion(cred)
+        if not parsed.user_handle:
             return jsonify({"error": "No userHandle in the response"}), 400
         
         state = get_challenge_state("_usernameless_")
         if not state:
             return jsonify({"error": "Login session expired"}), 400
         
-        #decode the usr_handle to get username using base64
-        # https://stackoverflow.com/questions/3302946/how-to-decode-base64-url-in-python
-        username = base64.urlsafe_b64decode(usr_handle + "==").decode("utf-8")
+        # the user handle is the username (set as the user id in register_start)
+        username = parsed.user_handle.decode("utf-8")
         print(f"Username from decoded usr_handle: {username}")
         
-        user = User.query.filter_by(username=username).first()
+        user = queries.user_by_username(username, current_tenant().id)
         if not user or not user.credentials:
             return jsonify({"error": "No user has been found"}), 404 
         # creds = CREDENTIALS.get(username)
@@ -642,32 +1021,18 @@ def login_finish_usernameless():
             credential_data_list.append(cred_data)
             
             
-        authentication_response = {
-            "id": cred["id"],
-            "rawId": cred["rawId"],
-            "response": {
-                "clientDataJSON": cred["response"]["clientDataJSON"],
-                "authenticatorData": cred["response"]["authenticatorData"],
-                "signature": cred["response"]["signature"],
-            },
-            "type": cred["type"],
-            "clientExtensionResults": cred.get("clientExtensionResults", {}),
-        }
-        
-        result = server.authenticate_complete(
+        result = get_server().authenticate_complete(
             state,
             credential_data_list,
-            authentication_response,
+            parsed.response,
         )
 
         # Sign count validation to detect cloned authenticators
-        # Extract sign count from authenticator data (bytes 33-37 are the 32-bit counter)
-        auth_data_bytes = websafe_decode(cred["response"]["authenticatorData"])
-        new_sign_count = int.from_bytes(auth_data_bytes[33:37], byteorder='big')
+        # counter comes from the already parsed authenticator data
+        new_sign_count = parsed.counter
 
-        credential_id_bytes = websafe_decode(cred["rawId"])
         for db_cred in user.credentials:
-            if db_cred.credential_id == credential_id_bytes:
+            if db_cred.credential_id == parsed.credential_id:
                 if new_sign_count <= db_cred.sign_count and db_cred.sign_count > 0:
                     print(f"WARNING: Possible cloned authenticator for {username}")
                     return jsonify({"error": "Authenticator may be cloned"}), 401
@@ -676,7 +1041,7 @@ def login_finish_usernameless():
                 break
         
         print(f"User {username} authenticated successfully (usernameless)!")
-        return jsonify({"status": "authenticated", "username": username})
+        return jsonify({"status": "authenticated", "username": username, **sessions.issue_session(tenant_redis(), username, current_tenant().rp_id)})
     except Exception as e:
         print(f"Error in login_finish_usernameless: {e}")
         traceback.print_exc()
@@ -704,7 +1069,7 @@ def recover_account():
     try:
         usr = request.json["username"]
         recovery_code = request.json["recovery_code"]
-        db_user = User.query.filter_by(username=usr).first()
+        db_user = queries.user_by_username(usr, current_tenant().id)
         
         # check if the user exists
         if not db_user: 
@@ -712,7 +1077,7 @@ def recover_account():
         
         hashed_code = hashcode(recovery_code)
         
-        recovery_code_record = RecoveryCode.query.filter_by(user_id=db_user.id, code_hash=hashed_code).first()
+        recovery_code_record = queries.recovery_code(db_user.id, hashed_code)
         if not recovery_code_record:
             return jsonify({"error": "Invalid recovery code"}), 400
         
@@ -742,7 +1107,7 @@ def recover_account():
             )
             exclude_credentials.append(cred_data)
             
-        options, state = server.register_begin(
+        options, state = get_server().register_begin(
                 user_entity,
                 credentials=exclude_credentials,
                 user_verification="required",
@@ -751,17 +1116,17 @@ def recover_account():
         
         USERS[usr] = user_entity
         # STATES[usr] = state
-        store_challenge_state(usr, state)
+        token = store_challenge_state(usr, state)
         
         options_dict = serialize_options(options)
         remaining_codes = RecoveryCode.query.filter_by(user_id=db_user.id).count()
         print(f"Recovery initiated for {usr}. Codes remaining: {remaining_codes}")
         
-        return jsonify({
+        return jsonify(with_challenge_token({
             "status": "recovery_approved",
             "options": options_dict,
             "codes_remaining": remaining_codes
-        })
+        }, token))
     except Exception as e:
         db.session.rollback()
         print(f"ERROR in recover_account: {e}")
@@ -770,24 +1135,28 @@ def recover_account():
     
     
         
-@app.route("/user/authenticators", methods=["POST"])
+@app.route("/user/authenticators", methods=["GET", "POST"])
 def get_user_authenticators():
     try:
-        usr = request.json["username"]
-        authenticators = []
-        user = User.query.filter_by(username=usr).first()
+        usr = request.args["username"] if request.method == "GET" else request.json["username"]
         
-        if not user:
-            return jsonify({"authenticators": []})
+        def build():
+            authenticators = []
+            user = queries.user_by_username(usr, current_tenant().id)
+            
+            if not user:
+                return jsonify({"authenticators": []})
+            
+            for cred in user.credentials:
+                authenticators.append({ # append creds to authenticators array
+                    "credential_id": cred.credential_id.hex(),
+                    "type": cred.authenticator_type,
+                    "registered_at": cred.created_at.strftime("%Y-%m-%d %H:%M")
+                })
+             
+            return jsonify({"authenticators" : authenticators})
         
-        for cred in user.credentials:
-            authenticators.append({ # append creds to authenticators array
-                "credential_id": cred.credential_id.hex(),
-                "type": cred.authenticator_type,
-                "registered_at": cred.created_at.strftime("%Y-%m-%d %H:%M")
-            })
-         
-        return jsonify({"authenticators" : authenticators})
+        return conditional_response("user_authenticators", build, username=usr)
     except Exception as e:
         print(f"Error in get_user_authenticators: {e}")
         traceback.print_exc()
@@ -796,31 +1165,138 @@ def get_user_authenticators():
 @app.route("/admin/attestations", methods=["GET"])
 def get_attestations():
     try:
-        all_attestations = []
-        creds = Credential.query.all()
-        
-        for cred in creds:
-            all_attestations.append({
-                "username": cred.user.username,
-                "credential_id": cred.credential_id.hex(),
-                "fmt": cred.attestation_fmt,
-                "trust_level": cred.trust_level,
-                "aaguid": cred.aaguid,
-                "mds_verified": cred.mds_verified,
-                "backup_eligible": cred.backup_eligible,
-                "backup_state": cred.backup_state,
-                "registered_at": cred.created_at.strftime("%Y-%m-%d %H:%M")
-                })
-             
-        return jsonify({"attestations": all_attestations})
+        def build():
+            all_attestations = []
+            creds = Credential.query.join(User).filter(User.tenant_id == current_tenant().id).all()
+            
+            for cred in creds:
+                all_attestations.append({
+                    "username": cred.user.username,
+                    "credential_id": cred.credential_id.hex(),
+                    "fmt": cred.attestation_fmt,
+                    "trust_level": cred.trust_level,
+                    "aaguid": cred.aaguid,
+                    "mds_verified": cred.mds_verified,
+                    "backup_eligible": cred.backup_eligible,
+                    "backup_state": cred.backup_state,
+                    "registered_at": cred.created_at.strftime("%Y-%m-%d %H:%M")
+                    })
+                 
+            return jsonify({"attestations": all_attestations})
+        
+        return conditional_response("admin_attestations", build)
     except Exception as e:
         print(f"Error in get_attestations: {e}")
         traceback.print_exc()
         return jsonify({"error": str(e)}), 500
+
+# Session endpoints
+# public keys for verifying access tokens locally
+# https://datatracker.ietf.org/doc/html/rfc7517#section-5
+@app.get("/.well-known/jwks.json")
+def get_jwks():
+    return jsonify(sessions.jwks())
+
+# swap a refresh token for a new access token and a new refresh token
+@app.route("/session/refresh", methods=["POST"])
+def refresh_session():
+    try:
+        session = sessions.refresh_session(tenant_redis(), request.json["refresh_token"], current_tenant().rp_id)
+        if not session:
+            return jsonify({"error": "Invalid or expired refresh token"}), 401
+        return jsonify(session)
+    except Exception as e:
+        print(f"Error in refresh_session: {e}")
+        traceback.print_exc()
+        return jsonify({"error": str(e)}), 500
+
+# logout
+@app.route("/session/revoke", methods=["POST"])
+def revoke_session():
+    try:
+        sessions.revoke_session(
+            tenant_redis(),
+            refresh_token=request.json.get("refresh_token"),
+            access_token=request.json.get("access_token"),
+        )
+        return jsonify({"status": "revoked"})
+    except Exception as e:
+        print(f"Error in revoke_session: {e}")
+        traceback.print_exc()
+        return jsonify({"error": str(e)}), 500
+
+# revoked access tokens and users, polled by resource servers
+@app.get("/session/revocations")
+def get_revocations():
+    try:
+        return jsonify(sessions.revocation_list(tenant_redis()))
+    except Exception as e:
+        print(f"Error in get_revocations: {e}")
+        traceback.print_exc()
+        return jsonify({"error": str(e)}), 500
+
+# fleet statistics for the admin dashboard
+# served from the redis counters so it does not scan the credentials table
+@app.route("/admin/stats", methods=["GET"])
+def get_fleet_stats():
+    try:
+        stats.ensure_stats(tenant_redis(), current_tenant().id)
+        return jsonify(stats.get_stats(tenant_redis()))
+    except Exception as e:
+        print(f"Error in get_fleet_stats: {e}")
+        traceback.print_exc()
+        return jsonify({"error": str(e)}), 500
+
+# reconciliation, rebuilds the counters from the credentials table
+@app.route("/admin/stats/rebuild", methods=["POST"])
+def rebuild_fleet_stats():
+    try:
+        return jsonify(stats.rebuild_stats(tenant_redis(), current_tenant().id))
+    except Exception as e:
+        print(f"Error in rebuild_fleet_stats: {e}")
+        traceback.print_exc()
+        return jsonify({"error": str(e)}), 500
+
+# same job from the command line for every tenant, e.g. from cron: flask --app app rebuild-stats
+# https://flask.palletsprojects.com/en/stable/cli/#custom-commands
+@app.cli.command("rebuild-stats")
+def rebuild_stats_command():
+    for tenant in TENANTS.all():
+        stats.rebuild_stats(tenant.redis(get_redis()), tenant.id)
+
+# bulk revocation from the command line, e.g. with a file of usernames, one per line
+# flask --app app revoke-bulk --usernames-file compromised.txt
+# flask --app app revoke-bulk --aaguid <hex> --registered-from 2026-01-01
+@app.cli.command("revoke-bulk")
+@click.option("--tenant", "tenant_id", default=tenants.DEFAULT_TENANT)
+@click.option("--usernames-file", type=click.File())
+@click.option("--aaguid")
+@click.option("--registered-from", type=click.DateTime())
+@click.option("--registered-to", type=click.DateTime())
+def revoke_bulk_command(tenant_id, usernames_file, aaguid, registered_from, registered_to):
+    tenant = TENANTS.get(tenant_id)
+    if tenant is None:
+        raise click.BadParameter(f"unknown tenant {tenant_id}", param_hint="--tenant")
+    redis_client = tenant.redis(get_redis())
+    if usernames_file:
+        usernames = [line.strip() for line in usernames_file if line.strip()]
+        result = revocation.revoke_users(redis_client, tenant.id, usernames)
+    else:
+        result = revocation.revoke_credentials(redis_client, tenant.id, aaguid=aaguid,
+                                               registered_from=registered_from, registered_to=registered_to)
+    print(json.dumps(result, indent=2))
         
           
 
 if __name__ == "__main__":
+    if FAST_START:
+        # schema is handled by python migrate.py, warm up while already accepting requests
+        start_warm_up()
+    else:
+        migrate()
+        if not warm_up():
+            start_warm_up()
+    
     # https://flask.palletsprojects.com/en/stable/server/
     # Use port 5001 to avoid conflict with macOS AirPlay on port 5000
     app.run(
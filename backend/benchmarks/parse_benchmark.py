@@ -0,0 +1,82 @@
+# Parsing microbenchmark, the old double decoding versus webauthn_parsing's single pass
+# payloads come from the software authenticator: "none" attestation (~200 byte attestation
+# object), "packed" with an x5c certificate (~780 bytes) and a login assertion
+# run from the backend folder: python benchmarks/parse_benchmark.py
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from fido2 import cbor
+from fido2.utils import websafe_decode, websafe_encode
+from fido2.webauthn import RegistrationResponse, AuthenticationResponse
+from webauthn_parsing import ParsedRegistration, ParsedAssertion
+from soft_authenticator import SoftAuthenticator
+
+RP_ID = "stephens-macbook-pro.local"
+ORIGIN = "https://stephens-macbook-pro.local:5173"
+
+
+def options(user_id=b"benchmark-user"):
+    return {"publicKey": {"challenge": websafe_encode(os.urandom(32)), "user": {"id": websafe_encode(user_id)}}}
+
+
+# what register_finish did before: fido2 parses the mapping, then the
+# attestation object is base64 and CBOR decoded again just to read fmt
+def old_registration(credential):
+    response = RegistrationResponse.from_dict({
+        "id": credential["id"],
+        "rawId": credential["rawId"],
+        "response": credential["response"],
+        "type": credential["type"],
+        "clientExtensionResults": credential.get("clientExtensionResults", {}),
+    })
+    fmt = cbor.decode(websafe_decode(credential["response"]["attestationObject"])).get("fmt", "none")
+    return response, fmt
+
+
+# what the login endpoints did before: fido2 parses the mapping, then the
+# authenticator data and rawId are base64 decoded again for the counter check
+def old_assertion(credential):
+    response = AuthenticationResponse.from_dict({
+        "id": credential["id"],
+        "rawId": credential["rawId"],
+        "response": credential["response"],
+        "type": credential["type"],
+        "clientExtensionResults": credential.get("clientExtensionResults", {}),
+    })
+    counter = int.from_bytes(websafe_decode(credential["response"]["authenticatorData"])[33:37], "big")
+    return response, counter, websafe_decode(credential["rawId"])
+
+
+def compare(name, count, old, new, payload):
+    old_time = min(timeit.repeat(lambda: old(payload), number=count, repeat=5)) / count
+    new_time = min(timeit.repeat(lambda: new(payload), number=count, repeat=5)) / count
+    print(f"{name:<22} old {old_time * 1e6:7.1f} us   new {new_time * 1e6:7.1f} us   "
+          f"speedup {old_time / new_time:4.2f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare WebAuthn payload parsing paths")
+    parser.add_argument("--count", type=int, default=5000)
+    args = parser.parse_args()
+
+    none_auth = SoftAuthenticator(RP_ID, ORIGIN, attestation="none")
+    packed_auth = SoftAuthenticator(RP_ID, ORIGIN, attestation="packed-x5c", attachment="cross-platform")
+    none_registration = none_auth.create(options())
+    packed_registration = packed_auth.create(options())
+    assertion = none_auth.get(options())
+
+    for label, credential in (("none", none_registration), ("packed + x5c", packed_registration)):
+        size = len(websafe_decode(credential["response"]["attestationObject"]))
+        print(f"{label} attestation object: {size} bytes")
+    print(f"assertion authenticator data: {len(websafe_decode(assertion['response']['authenticatorData']))} bytes\n")
+
+    compare("register (none)", args.count, old_registration, ParsedRegistration, none_registration)
+    compare("register (packed+x5c)", args.count, old_registration, ParsedRegistration, packed_registration)
+    compare("login assertion", args.count, old_assertion, ParsedAssertion, assertion)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,425 @@
+# Deterministic replay of a traffic capture (see capture.py) for performance regression testing
+# re-drives every captured ceremony against a fresh backend with the software authenticator,
+# keeping the captured mix of platform / cross-platform, none / packed attestation,
+# multi-passkey users, usernameless logins and recovery, then compares latency and throughput
+#
+# the software authenticator signs whatever challenge the backend issues, so no special backend setup is needed
+# run from the backend folder:
+#   python benchmarks/replay.py capture.jsonl.gz --url https://localhost:5001 --speeds 1,10,max
+# https://requests.readthedocs.io/en/latest/user/advanced/#session-objects
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import requests
+import urllib3
+from fido2.utils import websafe_decode
+from soft_authenticator import SoftAuthenticator
+
+
+# Loading the capture
+# a file that was appended to by several runs has several headers, the timestamps of each
+# segment are shifted so the whole file is one timeline
+def load_capture(path):
+    records = []
+    offset = 0.0
+    last = 0.0
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        try:
+            for line in f:
+                record = json.loads(line)
+                if "v" in record:
+                    offset = last
+                    continue
+                record["t"] += offset
+                last = record["t"]
+                records.append(record)
+        except EOFError:
+            # the capturing process was killed before it wrote the gzip trailer,
+            # every record was flushed so nothing before this point is lost
+            pass
+    return records
+
+
+# Turning requests into ceremonies
+# start/finish pairs become one action so the replay can answer the fresh challenge,
+# starts without a finish are replayed on their own (abandoned ceremonies are load too)
+def build_actions(records):
+    actions = []
+    pending = {}            # user -> open register / login / recover start
+    usernameless = []       # usernameless starts, matched to finishes in order
+
+    for record in records:
+        path, user = record["p"], record.get("u")
+        if path in ("/register/start", "/login/start", "/recover"):
+            action = {"kind": {"/register/start": "register", "/login/start": "login", "/recover": "recover"}[path],
+                      "t": record["t"], "user": user, "requests": [record]}
+            if record["s"] != 200:
+                actions.append(action)
+            else:
+                pending[user] = action
+        elif path == "/login/start/usernameless":
+            action = {"kind": "usernameless", "t": record["t"], "user": None, "requests": [record]}
+            usernameless.append(action)
+        elif path in ("/register/finish", "/login/finish"):
+            action = pending.pop(user, None)
+            if action is None:
+                continue
+            action["requests"].append(record)
+            action.update({k: record[k] for k in ("c", "a", "f", "be", "bs") if k in record})
+            actions.append(action)
+        elif path == "/login/finish/usernameless":
+            if not usernameless:
+                continue
+            action = usernameless.pop(0)
+            action["requests"].append(record)
+            action["user"] = user
+            action["c"] = record.get("c")
+            actions.append(action)
+        else:
+            # reads, passkey deletion and admin endpoints are single requests
+            actions.append({"kind": "single", "t": record["t"], "user": user, "c": record.get("c"), "requests": [record]})
+
+    # anything still open was abandoned after the start request
+    for action in list(pending.values()) + usernameless:
+        action["abandoned"] = True
+        actions.append(action)
+    actions.sort(key=lambda a: a["t"])
+    return actions
+
+
+# app time from "Server-Timing: app;dur=12.345"
+def server_timing(response):
+    for metric in response.headers.get("Server-Timing", "").split(","):
+        name, _, params = metric.strip().partition(";")
+        if name == "app" and params.startswith("dur="):
+            return float(params[4:])
+    return None
+
+
+# Replaying
+class Replayer:
+    def __init__(self, base_url, rp_id, origin, prefix, verify_tls):
+        self.base_url = base_url.rstrip("/")
+        self.rp_id = rp_id
+        self.origin = origin
+        self.prefix = prefix
+        self.verify_tls = verify_tls
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.results = []           # (endpoint, server ms, round trip ms, status, captured status)
+        self.credentials = {}       # credential pseudonym -> (authenticator, credential id)
+        self.authenticators = {}    # user -> {profile: SoftAuthenticator}
+        self.recovery_codes = {}    # user -> unused recovery codes
+
+    def session(self):
+        if not hasattr(self.local, "session"):
+            self.local.session = requests.Session()
+            self.local.session.verify = self.verify_tls
+        return self.local.session
+
+    def username(self, user):
+        return f"{self.prefix}{user}"
+
+    # one software authenticator per user and device profile, keys are derived from the
+    # pseudonym so repeated runs register the same credentials
+    def authenticator(self, user, attachment="platform", fmt="none", be=1, bs=1):
+        profile = (attachment, fmt, be, bs)
+        with self.lock:
+            devices = self.authenticators.setdefault(user, {})
+            if profile not in devices:
+                devices[profile] = SoftAuthenticator(
+                    self.rp_id, self.origin,
+                    attestation="packed-x5c" if fmt == "packed" else "none",
+                    attachment=attachment, backup_eligible=bool(be), backed_up=bool(bs),
+                    seed=f"{self.prefix}{user}:{profile}".encode(),
+                )
+            return devices[profile]
+
+    def call(self, method, path, captured=None, measure=True, **kwargs):
+        started = time.perf_counter()
+        response = self.session().request(method, self.base_url + path, **kwargs)
+        round_trip = (time.perf_counter() - started) * 1000
+        if measure:
+            endpoint = captured["p"] if captured else path
+            # the capture records time spent in the app, so compare against the
+            # backend's Server-Timing header and keep the round trip separately
+            server = server_timing(response) or round_trip
+            with self.lock:
+                self.results.append((f"{method} {endpoint}", server, round_trip, response.status_code,
+                                     captured["s"] if captured else None))
+        try:
+            return response.status_code, response.json()
+        except ValueError:
+            return response.status_code, None
+
+    def register(self, action):
+        user = action["user"]
+        username = self.username(user)
+        start, finish = (action["requests"] + [None])[:2]
+        attachment = action.get("a") or (start or {}).get("a") or "platform"
+        status, options = self.call("POST", "/register/start", start,
+                                    json={"username": username, "authenticator_type": attachment})
+        if status != 200 or finish is None:
+            return
+        device = self.authenticator(user, attachment, action.get("f", "none"), action.get("be", 1), action.get("bs", 1))
+        credential = device.create(options)
+        status, body = self.call("POST", "/register/finish", finish, json={
+            "username": username, "credential": credential, "challenge_token": options.get("challenge_token"),
+        })
+        if status == 200:
+            self.remember(action, device, credential)
+            if body and body.get("recovery_codes"):
+                with self.lock:
+                    self.recovery_codes[user] = list(body["recovery_codes"])
+
+    def remember(self, action, device, credential):
+        if action.get("c"):
+            with self.lock:
+                self.credentials[action["c"]] = (device, websafe_decode(credential["rawId"]))
+
+    def device_for(self, action):
+        if action.get("c") in self.credentials:
+            return self.credentials[action["c"]]
+        devices = list(self.authenticators.get(action["user"], {}).values())
+        return (devices[0], None) if devices else (None, None)
+
+    def login(self, action):
+        username = self.username(action["user"])
+        start, finish = (action["requests"] + [None])[:2]
+        status, options = self.call("POST", "/login/start", start, json={"username": username})
+        device, credential_id = self.device_for(action)
+        if status != 200 or finish is None or device is None:
+            return
+        self.call("POST", "/login/finish", finish, json={
+            "username": username,
+            "credential": device.get(options, credential_id),
+            "challenge_token": options.get("challenge_token"),
+        })
+
+    def usernameless(self, action):
+        start, finish = (action["requests"] + [None])[:2]
+        status, options = self.call("POST", "/login/start/usernameless", start, json={})
+        if status != 200 or finish is None or not action.get("user"):
+            return
+        device, credential_id = self.device_for(action)
+        if device is None:
+            return
+        self.call("POST", "/login/finish/usernameless", finish, json={
+            "credential": device.get(options, credential_id or next(iter(device.credentials))),
+            "challenge_token": options.get("challenge_token"),
+        })
+
+    def recover(self, action):
+        user = action["user"]
+        username = self.username(user)
+        start, finish = (action["requests"] + [None])[:2]
+        with self.lock:
+            codes = self.recovery_codes.get(user) or ["0000-0000"]
+            code = codes.pop(0) if len(codes) > 1 else codes[0]
+        status, body = self.call("POST", "/recover", start, json={"username": username, "recovery_code": code})
+        if status != 200 or finish is None:
+            return
+        options = body["options"]
+        device = self.authenticator(user, action.get("a") or "platform", action.get("f", "none"),
+                                    action.get("be", 1), action.get("bs", 1))
+        credential = device.create(options)
+        status, _ = self.call("POST", "/register/finish", finish, json={
+            "username": username, "credential": credential, "challenge_token": body.get("challenge_token"),
+        })
+        if status == 200:
+            self.remember(action, device, credential)
+
+    def single(self, action):
+        record = action["requests"][0]
+        username = self.username(action["user"]) if action.get("user") else None
+        path, method = record["p"], record["m"]
+        if path == "/user/passkeys/<id>":
+            # row ids differ in the fresh backend, find the passkey by its credential id
+            _, credential_id = self.credentials.get(action.get("c"), (None, None))
+            _, listing = self.call("GET", "/user/passkeys", measure=False, params={"username": username})
+            passkey_id = 0
+            for passkey in (listing or {}).get("passkeys", []):
+                if credential_id and passkey["credential_id"] == credential_id.hex():
+                    passkey_id = passkey["id"]
+            self.call("DELETE", f"/user/passkeys/{passkey_id}", record, json={"username": username})
+        elif method == "GET":
+            self.call("GET", path, record, params={"username": username} if username else None)
+        else:
+            self.call(method, path, record, json={"username": username} if username else {})
+
+    def run_action(self, action):
+        handler = getattr(self, action["kind"])
+        try:
+            handler(action)
+        except Exception as e:
+            with self.lock:
+                self.results.append((f"{action['kind']} (client error)", 0.0, 0.0, 0, None))
+            print(f"Replay error in {action['kind']}: {e}")
+
+    # users that already existed when the capture started get their passkeys registered
+    # up front, this is not measured
+    def prime(self, actions):
+        registered = set()
+        for action in actions:
+            if action["kind"] in ("register", "recover") and action.get("c"):
+                registered.add(action["c"])
+        seen = set()
+        for action in actions:
+            cred = action.get("c")
+            if action["kind"] not in ("login", "usernameless", "single") or not action.get("user"):
+                continue
+            if cred in registered or (cred or action["user"]) in seen:
+                continue
+            seen.add(cred or action["user"])
+            self.prime_register(action)
+
+    def prime_register(self, action):
+        user = action["user"]
+        username = self.username(user)
+        status, options = self.call("POST", "/register/start", measure=False,
+                                    json={"username": username, "authenticator_type": action.get("a") or "platform"})
+        if status != 200:
+            return
+        device = self.authenticator(user, action.get("a") or "platform")
+        credential = device.create(options)
+        status, body = self.call("POST", "/register/finish", measure=False, json={
+            "username": username, "credential": credential, "challenge_token": options.get("challenge_token"),
+        })
+        if status == 200:
+            self.remember(action, device, credential)
+            if body and body.get("recovery_codes"):
+                self.recovery_codes[user] = list(body["recovery_codes"])
+
+    # controlled clock: action i starts at its captured offset divided by the speed,
+    # actions of one user run in order, different users run concurrently
+    def replay(self, actions, speed, concurrency):
+        self.prime(actions)
+        self.results = []
+        first = actions[0]["t"] if actions else 0.0
+        previous = {}
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            for action in actions:
+                if speed:
+                    delay = (action["t"] - first) / speed - (time.perf_counter() - started)
+                    if delay > 0:
+                        time.sleep(delay)
+                before = previous.get(action.get("user"))
+
+                def run(action=action, before=before):
+                    if before is not None:
+                        before.result()
+                    self.run_action(action)
+
+                future = pool.submit(run)
+                if action.get("user"):
+                    previous[action["user"]] = future
+        return time.perf_counter() - started
+
+
+# Report
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def report(records, results, elapsed, speed_label):
+    captured = {}
+    for record in records:
+        captured.setdefault(f"{record['m']} {record['p']}", []).append(record["ms"])
+    replayed = {}
+    round_trips = {}
+    mismatches = 0
+    for endpoint, latency, round_trip, status, expected in results:
+        replayed.setdefault(endpoint, []).append(latency)
+        round_trips.setdefault(endpoint, []).append(round_trip)
+        if expected is not None and status != expected:
+            mismatches += 1
+
+    captured_span = (records[-1]["t"] - records[0]["t"]) if len(records) > 1 else 0.0
+    summary = {
+        "speed": speed_label,
+        "captured_requests": len(records),
+        "captured_seconds": round(captured_span, 3),
+        "replayed_requests": len(results),
+        "replayed_seconds": round(elapsed, 3),
+        "replayed_rps": round(len(results) / elapsed, 2) if elapsed else 0.0,
+        "status_mismatches": mismatches,
+        "endpoints": {},
+    }
+
+    print(f"\n=== replay at {speed_label} ===")
+    print(f"{'endpoint':<38}{'n':>6}{'cap p50':>10}{'cap p95':>10}{'new p50':>10}{'new p95':>10}{'p50 delta':>11}{'rtt p50':>10}")
+    for endpoint in sorted(set(captured) | set(replayed)):
+        cap, new = captured.get(endpoint, []), replayed.get(endpoint, [])
+        row = {
+            "count": len(new),
+            "captured_p50_ms": round(percentile(cap, 0.5), 3),
+            "captured_p95_ms": round(percentile(cap, 0.95), 3),
+            "replayed_p50_ms": round(percentile(new, 0.5), 3),
+            "replayed_p95_ms": round(percentile(new, 0.95), 3),
+            "round_trip_p50_ms": round(percentile(round_trips.get(endpoint, []), 0.5), 3),
+        }
+        delta = ((row["replayed_p50_ms"] / row["captured_p50_ms"] - 1) * 100) if cap and new and row["captured_p50_ms"] else None
+        row["p50_delta_pct"] = round(delta, 1) if delta is not None else None
+        summary["endpoints"][endpoint] = row
+        print(f"{endpoint:<38}{len(new):>6}{row['captured_p50_ms']:>10.1f}{row['captured_p95_ms']:>10.1f}"
+              f"{row['replayed_p50_ms']:>10.1f}{row['replayed_p95_ms']:>10.1f}"
+              f"{(f'{delta:+.1f}%' if delta is not None else '-'):>11}{row['round_trip_p50_ms']:>10.1f}")
+    print(f"captured: {len(records)} requests over {captured_span:.1f}s   "
+          f"replayed: {len(results)} requests in {elapsed:.1f}s ({summary['replayed_rps']} req/s)   "
+          f"status mismatches: {mismatches}")
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a traffic capture against a backend")
+    parser.add_argument("capture")
+    parser.add_argument("--url", default="https://localhost:5001")
+    parser.add_argument("--rp-id", default="stephens-macbook-pro.local")
+    parser.add_argument("--origin", default="https://stephens-macbook-pro.local:5173")
+    parser.add_argument("--speeds", default="1,10,max", help="comma separated, e.g. 1,10,max")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--run-id", default=None, help="prefix for replayed usernames, defaults to a hash of the capture")
+    parser.add_argument("--insecure", action="store_true", help="skip TLS verification (mkcert / self signed)")
+    parser.add_argument("--report", help="write the comparison as JSON to this file")
+    args = parser.parse_args()
+
+    if args.insecure:
+        urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    records = load_capture(args.capture)
+    actions = build_actions(records)
+    kinds = {}
+    for action in actions:
+        kinds[action["kind"]] = kinds.get(action["kind"], 0) + 1
+    print(f"{len(records)} requests, {len(actions)} actions: {kinds}")
+
+    run_id = args.run_id or hashlib.sha256(args.capture.encode()).hexdigest()[:6]
+    summaries = []
+    for speed in args.speeds.split(","):
+        speed = speed.strip()
+        factor = 0 if speed == "max" else float(speed)
+        label = "max speed" if speed == "max" else f"{speed}x"
+        # every speed gets its own users so the runs do not interfere
+        replayer = Replayer(args.url, args.rp_id, args.origin, f"{run_id}-{speed}-", not args.insecure)
+        elapsed = replayer.replay(actions, factor, args.concurrency)
+        summaries.append(report(records, replayer.results, elapsed, label))
+
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(summaries, f, indent=2)
+        print(f"\nreport written to {args.report}")
+
+
+if __name__ == "__main__":
+    main()
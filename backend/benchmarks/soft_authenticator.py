@@ -0,0 +1,153 @@
+# Software authenticator for benchmarks and the replay tool
+# produces the same JSON the browser sends (via SimpleWebAuthn) for registration and login,
+# with "none" or "packed" attestation, platform or cross-platform attachment and
+# backup flags, so the backend can be driven without a real device
+# https://www.w3.org/TR/webauthn-3/#sctn-authenticator-data
+# https://www.w3.org/TR/webauthn-3/#sctn-packed-attestation
+import datetime
+import hashlib
+import json
+import struct
+from fido2 import cbor
+from fido2.cose import ES256
+from fido2.utils import websafe_encode, websafe_decode
+from cryptography import x509
+from cryptography.x509.oid import NameOID
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+
+FLAG_UP = 0x01
+FLAG_UV = 0x04
+FLAG_BE = 0x08
+FLAG_BS = 0x10
+FLAG_AT = 0x40
+
+
+# keys derived from a seed so a replay run creates the same credentials every time
+def derive_key(seed):
+    secret = int.from_bytes(hashlib.sha256(seed).digest(), "big") % (2**256 - 2**224) + 1
+    return ec.derive_private_key(secret, ec.SECP256R1())
+
+
+# self signed attestation certificate that meets the packed attestation requirements
+# https://www.w3.org/TR/webauthn-3/#sctn-packed-attestation-cert-requirements
+def attestation_certificate(key):
+    subject = x509.Name([
+        x509.NameAttribute(NameOID.COUNTRY_NAME, "IE"),
+        x509.NameAttribute(NameOID.ORGANIZATION_NAME, "Soft Authenticator"),
+        x509.NameAttribute(NameOID.ORGANIZATIONAL_UNIT_NAME, "Authenticator Attestation"),
+        x509.NameAttribute(NameOID.COMMON_NAME, "Soft Authenticator Attestation"),
+    ])
+    now = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(subject)
+        .issuer_name(subject)
+        .public_key(key.public_key())
+        .serial_number(1)
+        .not_valid_before(now)
+        .not_valid_after(now + datetime.timedelta(days=3650))
+        .add_extension(x509.BasicConstraints(ca=False, path_length=None), critical=True)
+        .sign(key, hashes.SHA256())
+    )
+    return cert.public_bytes(serialization.Encoding.DER)
+
+
+class SoftAuthenticator:
+    def __init__(self, rp_id, origin, attestation="none", attachment="platform",
+                 backup_eligible=True, backed_up=True, aaguid=bytes(16), seed=b"soft-authenticator"):
+        self.rp_id_hash = hashlib.sha256(rp_id.encode()).digest()
+        self.origin = origin
+        self.attestation = attestation
+        self.attachment = attachment
+        self.aaguid = aaguid
+        self.seed = seed
+        self.backup_flags = (FLAG_BE if backup_eligible else 0) | (FLAG_BS if backup_eligible and backed_up else 0)
+        # credential id -> [private key, sign count, user handle]
+        self.credentials = {}
+        if attestation == "packed-x5c":
+            self.attestation_key = derive_key(seed + b":attestation")
+            self.attestation_cert = attestation_certificate(self.attestation_key)
+
+    def client_data(self, ceremony, challenge):
+        return json.dumps({
+            "type": ceremony,
+            "challenge": challenge,
+            "origin": self.origin,
+            "crossOrigin": False,
+        }, separators=(",", ":")).encode()
+
+    # navigator.credentials.create(), takes the options returned by /register/start
+    def create(self, options):
+        public_key = options["publicKey"]
+        index = len(self.credentials)
+        user_handle = public_key["user"]["id"]
+        key = derive_key(self.seed + f":{user_handle}:{index}".encode())
+        credential_id = hashlib.sha256(self.seed + f":credential:{user_handle}:{index}".encode()).digest()
+        self.credentials[credential_id] = [key, 0, user_handle]
+
+        client_data = self.client_data("webauthn.create", public_key["challenge"])
+        auth_data = (
+            self.rp_id_hash
+            + struct.pack(">BI", FLAG_UP | FLAG_UV | FLAG_AT | self.backup_flags, 0)
+            + self.aaguid
+            + struct.pack(">H", len(credential_id))
+            + credential_id
+            + cbor.encode(ES256.from_cryptography_key(key.public_key()))
+        )
+        signed = auth_data + hashlib.sha256(client_data).digest()
+        if self.attestation == "packed":
+            # self attestation, signed with the credential key itself
+            fmt, statement = "packed", {"alg": -7, "sig": key.sign(signed, ec.ECDSA(hashes.SHA256()))}
+        elif self.attestation == "packed-x5c":
+            fmt, statement = "packed", {
+                "alg": -7,
+                "sig": self.attestation_key.sign(signed, ec.ECDSA(hashes.SHA256())),
+                "x5c": [self.attestation_cert],
+            }
+        else:
+            fmt, statement = "none", {}
+
+        attestation_object = cbor.encode({"fmt": fmt, "attStmt": statement, "authData": auth_data})
+        encoded_id = websafe_encode(credential_id)
+        return {
+            "id": encoded_id,
+            "rawId": encoded_id,
+            "type": "public-key",
+            "authenticatorAttachment": self.attachment,
+            "response": {
+                "clientDataJSON": websafe_encode(client_data),
+                "attestationObject": websafe_encode(attestation_object),
+            },
+            "clientExtensionResults": {},
+        }
+
+    # navigator.credentials.get(), takes the options returned by /login/start
+    # uses the first allowed credential, or any stored one for usernameless logins
+    def get(self, options, credential_id=None):
+        public_key = options["publicKey"]
+        if credential_id is None:
+            allowed = [websafe_decode(c["id"]) for c in public_key.get("allowCredentials") or []]
+            matches = [cid for cid in allowed if cid in self.credentials] or list(self.credentials)
+            credential_id = matches[0]
+        entry = self.credentials[credential_id]
+        entry[1] += 1
+        key, counter, user_handle = entry
+
+        client_data = self.client_data("webauthn.get", public_key["challenge"])
+        auth_data = self.rp_id_hash + struct.pack(">BI", FLAG_UP | FLAG_UV | self.backup_flags, counter)
+        signature = key.sign(auth_data + hashlib.sha256(client_data).digest(), ec.ECDSA(hashes.SHA256()))
+        encoded_id = websafe_encode(credential_id)
+        return {
+            "id": encoded_id,
+            "rawId": encoded_id,
+            "type": "public-key",
+            "authenticatorAttachment": self.attachment,
+            "response": {
+                "clientDataJSON": websafe_encode(client_data),
+                "authenticatorData": websafe_encode(auth_data),
+                "signature": websafe_encode(signature),
+                "userHandle": user_handle,
+            },
+            "clientExtensionResults": {},
+        }
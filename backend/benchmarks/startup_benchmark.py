@@ -0,0 +1,105 @@
+# Startup benchmark, measures how long a fresh process takes to import app.py
+# and to answer its first successful /login/start
+# needs the same DATABASE_URL / REDIS_URL as the app, run from the backend folder:
+#   python benchmarks/startup_benchmark.py --runs 5
+# https://docs.python.org/3/library/time.html#time.perf_counter
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_USER = "startup-benchmark-user"
+
+# runs inside a brand new interpreter so nothing is already imported
+CHILD = """
+import json, sys, time
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+if not app.FAST_START:
+    # eager mode does the same work python app.py does before serving
+    app.warm_up()
+client = app.app.test_client()
+deadline = imported + 60
+while True:
+    response = client.post("/login/start", json={"username": sys.argv[1]})
+    if response.status_code == 200 or time.perf_counter() > deadline:
+        break
+    time.sleep(0.01)
+done = time.perf_counter()
+print(json.dumps({
+    "import_ms": (imported - started) * 1000,
+    "first_login_start_ms": (done - started) * 1000,
+    "status": response.status_code,
+}))
+"""
+
+
+# register a user with a generated public key so /login/start has something to return
+# the key is never used to sign, the benchmark only needs the start ceremony
+def seed_user():
+    sys.path.insert(0, BACKEND_DIR)
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from fido2 import cbor
+    from fido2.cose import ES256
+    import app
+    from models import db, User, Credential
+
+    app.migrate()
+    with app.app.app_context():
+        if User.query.filter_by(username=BENCH_USER).first():
+            return
+        user = User(username=BENCH_USER)
+        db.session.add(user)
+        db.session.flush()
+        public_key = ES256.from_cryptography_key(ec.generate_private_key(ec.SECP256R1()).public_key())
+        db.session.add(Credential(
+            user_id=user.id,
+            credential_id=os.urandom(32),
+            public_key=cbor.encode(public_key),
+            authenticator_type="platform",
+            aaguid="unknown",
+            attestation_fmt="none",
+            trust_level="self-attestation",
+        ))
+        db.session.commit()
+
+
+def run_once(fast_start):
+    env = dict(os.environ, FAST_START="1" if fast_start else "0", PYTHONDONTWRITEBYTECODE="1")
+    result = subprocess.run(
+        [sys.executable, "-c", CHILD, BENCH_USER],
+        cwd=BACKEND_DIR, env=env, capture_output=True, text=True, check=True,
+    )
+    # the app prints request logs, the measurement is the last line
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def summarise(name, samples):
+    for metric in ("import_ms", "first_login_start_ms"):
+        values = sorted(sample[metric] for sample in samples)
+        print(f"{name:<6} {metric:<22} median {statistics.median(values):8.1f} ms   "
+              f"min {values[0]:8.1f} ms   max {values[-1]:8.1f} ms")
+    failed = [sample for sample in samples if sample["status"] != 200]
+    if failed:
+        print(f"{name:<6} {len(failed)} run(s) never got a 200 from /login/start")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure import time and time to first /login/start")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--mode", choices=["fast", "eager", "both"], default="both")
+    args = parser.parse_args()
+
+    seed_user()
+    modes = ["fast", "eager"] if args.mode == "both" else [args.mode]
+    for mode in modes:
+        samples = [run_once(mode == "fast") for _ in range(args.runs)]
+        summarise(mode, samples)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+import os
+import gzip
+import json
+import hmac
+import time
+import atexit
+import hashlib
+import secrets
+import threading
+from flask import g, request
+# fcntl is unix only, without it nothing stops two processes sharing the file
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+from fido2 import cbor
+from fido2.utils import websafe_decode
+
+# Traffic capture for performance regression testing
+# every ceremony request is written as one compact JSON line to a gzip file (CAPTURE_FILE),
+# usernames and credential ids are replaced with keyed pseudonyms, signatures, challenges,
+# recovery codes and tokens are never written, only their sizes or counts
+# the capture is re-driven against a fresh backend by benchmarks/replay.py
+#
+# record keys: t seconds since capture start, m method, p path, s status, ms latency,
+#   u user pseudonym, c credential pseudonym, a authenticator attachment, f attestation fmt,
+#   be / bs backup flags, sig signature length, ul usernameless, rc recovery codes returned
+# error messages are not recorded as they echo request input such as usernames, the status is enough
+CAPTURE_VERSION = 1
+
+# requests that are not part of the traffic mix
+SKIPPED_PREFIXES = ("/health", "/metrics", "/.well-known")
+
+
+class TrafficCapture:
+    def __init__(self, path, salt=None):
+        # the salt keys the pseudonyms, keep it secret or pseudonyms can be brute forced
+        self.salt = (salt or secrets.token_hex(16)).encode()
+        self.path = path
+        self.lock = threading.Lock()
+        self.raw = None
+        self.file = None
+        self.disabled = False
+        atexit.register(self.close)
+
+    # opened on the first request rather than at import: under python app.py the reloader's
+    # watcher process imports the app too but never serves, and two writers appending
+    # separate gzip members to one file corrupt it
+    # the exclusive lock keeps any other process (a second worker) out for the same reason
+    def open(self):
+        with self.lock:
+            if self.file is not None or self.disabled:
+                return not self.disabled
+            raw = open(self.path, "ab")
+            if fcntl:
+                try:
+                    fcntl.flock(raw, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    raw.close()
+                    self.disabled = True
+                    print(f"{self.path} is being written by another process, not capturing in pid {os.getpid()}")
+                    return False
+            self.raw = raw
+            self.file = gzip.open(raw, "at", encoding="utf-8")
+            self.started = time.monotonic()
+        self.write({"v": CAPTURE_VERSION, "started": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())})
+        return True
+
+    def pseudonym(self, prefix, value):
+        if value is None:
+            return None
+        if isinstance(value, str):
+            value = value.encode()
+        return f"{prefix}-{hmac.new(self.salt, value, hashlib.sha256).hexdigest()[:16]}"
+
+    def write(self, record):
+        line = json.dumps(record, separators=(",", ":"))
+        with self.lock:
+            self.file.write(line + "\n")
+            # sync flush keeps the compression dictionary, so records survive a killed
+            # process without losing much compression
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            if self.file is not None and not self.file.closed:
+                # closing the gzip stream leaves the file it wraps open
+                self.file.close()
+                self.raw.close()
+
+    # latency is measured from app.py's log_request hook (g.request_started)
+    def before_request(self):
+        # a deleted passkey is gone by the time the response is written, so look it up now
+        if request.method == "DELETE" and request.path.startswith("/user/passkeys/"):
+            from queries import user_by_username, credential_for_user
+            try:
+                passkey_id = int(request.path.rsplit("/", 1)[1])
+                user = user_by_username((request.get_json(silent=True) or {}).get("username"), g.tenant.id)
+                cred = credential_for_user(passkey_id, user.id) if user else None
+                g.capture_credential = cred.credential_id if cred else None
+            except Exception as e:
+                print(f"Error looking up passkey for capture: {e}")
+
+    def after_request(self, response):
+        started = g.get("request_started")
+        if started is None or request.method == "OPTIONS" or request.path == "/" \
+                or request.path.startswith(SKIPPED_PREFIXES):
+            return response
+        try:
+            if not self.open():
+                return response
+            self.write(self.describe(response, (time.perf_counter() - started) * 1000))
+        except Exception as e:
+            # capture must never break the request it is recording
+            print(f"Error writing capture record: {e}")
+        return response
+
+    # the parts of a request/response that matter for replay, nothing secret
+    def describe(self, response, latency_ms):
+        path = request.path
+        body = request.get_json(silent=True) or {}
+        record = {
+            "t": round(time.monotonic() - self.started, 4),
+            "m": request.method,
+            "p": "/user/passkeys/<id>" if path.startswith("/user/passkeys/") else path,
+            "s": response.status_code,
+            "ms": round(latency_ms, 3),
+        }
+
+        username = body.get("username") or request.args.get("username")
+        credential = body.get("credential") or {}
+        if credential.get("rawId"):
+            record["c"] = self.pseudonym("c", websafe_decode(credential["rawId"]))
+        if getattr(g, "capture_credential", None):
+            record["c"] = self.pseudonym("c", g.capture_credential)
+
+        if path.endswith("/usernameless"):
+            record["ul"] = 1
+            handle = credential.get("response", {}).get("userHandle")
+            if handle:
+                username = websafe_decode(handle).decode("utf-8", "replace")
+        record["u"] = self.pseudonym("u", username)
+
+        if path == "/register/start":
+            record["a"] = body.get("authenticator_type", "platform")
+        if credential.get("authenticatorAttachment"):
+            record["a"] = credential["authenticatorAttachment"]
+
+        attestation_object = credential.get("response", {}).get("attestationObject")
+        if attestation_object:
+            decoded = cbor.decode(websafe_decode(attestation_object))
+            record["f"] = decoded.get("fmt", "none")
+            flags = decoded["authData"][32]
+            record["be"], record["bs"] = int(bool(flags & 0x08)), int(bool(flags & 0x10))
+        signature = credential.get("response", {}).get("signature")
+        if signature:
+            record["sig"] = len(websafe_decode(signature))
+
+        payload = response.get_json(silent=True) if response.is_json and not response.direct_passthrough else None
+        # only the list of codes returned on first registration, /admin/revoke/bulk returns a count
+        if isinstance(payload, dict) and isinstance(payload.get("recovery_codes"), list):
+            record["rc"] = len(payload["recovery_codes"])
+        return {k: v for k, v in record.items() if v is not None}
+
+
+def install(app, path, salt=None):
+    capture = TrafficCapture(path, salt)
+    app.before_request(capture.before_request)
+    app.after_request(capture.after_request)
+    print(f"Capturing traffic to {path}")
+    return capture
+
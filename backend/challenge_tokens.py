@@ -0,0 +1,88 @@
+import os
+import time
+import base64
+import secrets
+from fido2 import cbor
+from fido2.utils import websafe_decode, websafe_encode
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+# Stateless challenge tokens
+# the fido2 state is sealed with AES-GCM and handed to the client instead of being
+# written to redis, the finish endpoint opens it again and checks it has not been used
+# https://cryptography.io/en/latest/hazmat/primitives/aead/#cryptography.hazmat.primitives.ciphers.aead.AESGCM
+# token layout: <key id>.<base64url(nonce || ciphertext || tag)>
+TOKEN_TTL = 300  # same 5 minute window as the redis challenge store
+USED_PREFIX = "challenge_used"
+
+
+# keys come from CHALLENGE_TOKEN_KEYS="kid:base64key,kid:base64key"
+# the first key seals new tokens, every listed key can still open tokens,
+# so a key is rotated by putting a new one first and dropping the old one after TTL
+def load_keys():
+    keys = {}
+    active = None
+    for entry in os.environ.get("CHALLENGE_TOKEN_KEYS", "").split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        kid, _, encoded = entry.partition(":")
+        keys[kid] = AESGCM(base64.b64decode(encoded))
+        active = active or kid
+
+    if not keys:
+        # fine for a single process, several workers need the same keys in the environment
+        print("CHALLENGE_TOKEN_KEYS is not set, using a random key for this process")
+        active = "local"
+        keys[active] = AESGCM(AESGCM.generate_key(bit_length=256))
+    return active, keys
+
+ACTIVE_KID, KEYS = load_keys()
+
+
+# binds the token to the ceremony key (username or _usernameless_) without storing it
+def associated_data(kid, key):
+    return f"{kid}:{key}".encode()
+
+
+# seal the serialised fido2 state, returns the token for the client
+def issue(key, state):
+    nonce = secrets.token_bytes(12)
+    payload = cbor.encode({
+        "id": secrets.token_bytes(16),
+        "exp": int(time.time()) + TOKEN_TTL,
+        "state": state,
+    })
+    sealed = KEYS[ACTIVE_KID].encrypt(nonce, payload, associated_data(ACTIVE_KID, key))
+    return f"{ACTIVE_KID}.{websafe_encode(nonce + sealed)}"
+
+
+# open a token and mark it used, returns the state or None if it is invalid,
+# expired, for a different ceremony or already consumed
+# https://redis.io/docs/latest/commands/set/ (NX + EX)
+def consume(redis_client, key, token):
+    try:
+        kid, _, body = token.partition(".")
+        aead = KEYS.get(kid)
+        if aead is None:
+            return None
+        raw = websafe_decode(body)
+        payload = cbor.decode(aead.decrypt(raw[:12], raw[12:], associated_data(kid, key)))
+    except Exception as e:
+        print(f"Rejected challenge token: {e}")
+        return None
+
+    remaining = payload["exp"] - int(time.time())
+    if remaining <= 0:
+        return None
+
+    # only finished ceremonies are recorded, and only until the token would have expired anyway
+    if not redis_client.set(f"{USED_PREFIX}:{payload['id'].hex()}", 1, nx=True, ex=remaining):
+        print("Rejected challenge token: already used")
+        return None
+    return payload["state"]
+
+
+# prints a new key entry for CHALLENGE_TOKEN_KEYS
+if __name__ == "__main__":
+    kid = secrets.token_hex(2)
+    print(f"{kid}:{base64.b64encode(AESGCM.generate_key(bit_length=256)).decode()}")
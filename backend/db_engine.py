@@ -0,0 +1,121 @@
+import os
+import time
+import sqlite3
+import threading
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool, NullPool
+
+# SQLAlchemy engine configuration and connection pool metrics
+# https://docs.sqlalchemy.org/en/20/core/pooling.html
+# https://flask-sqlalchemy.readthedocs.io/en/stable/config/#flask_sqlalchemy.config.SQLALCHEMY_ENGINE_OPTIONS
+
+
+# checkout wait times, shared by every pool in the process
+class PoolMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.checkouts = 0
+        self.failures = 0
+        self.wait_total_ms = 0.0
+        self.wait_max_ms = 0.0
+
+    def record(self, wait_ms, failed=False):
+        with self.lock:
+            if failed:
+                self.failures += 1
+                return
+            self.checkouts += 1
+            self.wait_total_ms += wait_ms
+            self.wait_max_ms = max(self.wait_max_ms, wait_ms)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "checkouts": self.checkouts,
+                "checkout_failures": self.failures,
+                "checkout_wait_avg_ms": round(self.wait_total_ms / self.checkouts, 3) if self.checkouts else 0.0,
+                "checkout_wait_max_ms": round(self.wait_max_ms, 3),
+            }
+
+METRICS = PoolMetrics()
+
+
+# QueuePool that times how long a request waits to get a connection,
+# which includes waiting for a free slot, opening an overflow connection and pre-ping
+class TimedQueuePool(QueuePool):
+    def connect(self):
+        started = time.perf_counter()
+        try:
+            conn = super().connect()
+        except Exception:
+            METRICS.record(0, failed=True)
+            raise
+        METRICS.record((time.perf_counter() - started) * 1000)
+        return conn
+
+
+def env_int(name, default):
+    return int(os.environ.get(name, default))
+
+def env_flag(name, default):
+    return os.environ.get(name, default) == "1"
+
+
+# engine options from the environment
+#   DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, DB_POOL_RECYCLE, DB_POOL_PRE_PING
+#   DB_QUERY_CACHE_SIZE  size of the compiled statement cache
+#   DB_PGBOUNCER=1       PgBouncer transaction pooling, PgBouncer owns the pool so
+#                        connections are not kept open here (NullPool)
+# https://docs.sqlalchemy.org/en/20/core/engines.html#sqlalchemy.create_engine
+def engine_options(database_uri):
+    options = {"query_cache_size": env_int("DB_QUERY_CACHE_SIZE", 1200)}
+
+    # sqlite is only used for local experiments and picks its own pool
+    if database_uri.startswith("sqlite"):
+        return options
+
+    if env_flag("DB_PGBOUNCER", "0"):
+        # psycopg2 does not use server side prepared statements, so nothing
+        # is left behind on the server connection between transactions
+        options["poolclass"] = NullPool
+        return options
+
+    options.update({
+        "poolclass": TimedQueuePool,
+        "pool_size": env_int("DB_POOL_SIZE", 5),
+        "max_overflow": env_int("DB_MAX_OVERFLOW", 10),
+        "pool_timeout": env_int("DB_POOL_TIMEOUT", 30),
+        "pool_recycle": env_int("DB_POOL_RECYCLE", 1800),
+        "pool_pre_ping": env_flag("DB_POOL_PRE_PING", "1"),
+    })
+    return options
+
+
+# sqlite ignores foreign keys unless they are switched on for each connection,
+# the ON DELETE CASCADE constraints used by bulk revocation depend on them
+# https://docs.sqlalchemy.org/en/20/dialects/sqlite.html#foreign-key-support
+@event.listens_for(Engine, "connect")
+def sqlite_foreign_keys(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.close()
+
+
+# current pool state plus the checkout wait times
+def pool_metrics(engine):
+    pool = engine.pool
+    metrics = {"pool": type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        metrics.update({
+            "size": pool.size(),
+            "checked_in": pool.checkedin(),
+            "in_use": pool.checkedout(),
+            "overflow": max(pool.overflow(), 0),
+        })
+    metrics.update(METRICS.snapshot())
+    return metrics
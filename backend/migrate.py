@@ -0,0 +1,12 @@
+# Creates the database schema, run once before starting the app
+# e.g. python migrate.py && FAST_START=1 python app.py
+# the same command is available as: flask --app app migrate
+# --existing-tenant moves the users created before tenants to that tenant
+import argparse
+from app import migrate
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create or upgrade the database schema")
+    parser.add_argument("--existing-tenant", help="tenant that takes over the users created before tenants")
+    args = parser.parse_args()
+    migrate(args.existing_tenant)
@@ -7,22 +7,28 @@ db = SQLAlchemy()
 # database model for users
 class User(db.Model):
     __tablename__ = 'users'
+    # usernames are unique per tenant (see tenants.py), not across the whole fleet
+    __table_args__ = (db.UniqueConstraint('tenant_id', 'username', name='uq_users_tenant_username'),)
     
     id = db.Column(db.Integer, primary_key = True)
-    username = db.Column(db.String(80), unique=True, nullable=False)
-    created_at = db.Column(db.DateTime, default=datetime.now(timezone.utc))
+    tenant_id = db.Column(db.String(64), nullable=False, default='default', server_default='default')
+    username = db.Column(db.String(80), nullable=False)
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
     
     # the relationships 
     # https://medium.com/@philipdutra/understanding-relationships-in-flask-sqlalchemy-one-to-many-vs-many-to-many-6050d04c6cf0
-    credentials = db.relationship('Credential', backref='user', lazy=True, cascade='all, delete-orphan')
-    recovery_codes = db.relationship('RecoveryCode', backref='user', lazy=True, cascade='all, delete-orphan')
+    # passive_deletes leaves the children to the database's ON DELETE CASCADE, so deleting
+    # a user does not load its credentials and recovery codes and delete them one by one
+    # https://docs.sqlalchemy.org/en/20/orm/cascades.html#using-foreign-key-on-delete-cascade-with-orm-relationships
+    credentials = db.relationship('Credential', backref='user', lazy=True, cascade='all, delete-orphan', passive_deletes=True)
+    recovery_codes = db.relationship('RecoveryCode', backref='user', lazy=True, cascade='all, delete-orphan', passive_deletes=True)
 
     
 class Credential(db.Model):
     __tablename__ = 'credentials'
     
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False, index=True)
     
     # the WebAuthn credential data  
     credential_id = db.Column(db.LargeBinary, nullable=False)
@@ -32,7 +38,7 @@ class Credential(db.Model):
     # The authenticator information
     # platform or cross-platform
     authenticator_type = db.Column(db.String(20)) 
-    aaguid = db.Column(db.String(36))
+    aaguid = db.Column(db.String(36), index=True)
     
     # Backup state
     backup_eligible = db.Column(db.Boolean, default=False)
@@ -43,7 +49,9 @@ class Credential(db.Model):
     trust_level = db.Column(db.String(20))
     mds_verified = db.Column(db.Boolean, default=False)
     
-    created_at = db.Column(db.DateTime, default=datetime.now(timezone.utc))
+    # indexed for bulk revocation by registration date
+    # the default is a callable so it runs for every row, not once when the module is imported
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc), index=True)
 
 # recovery code model
 # https://flask-sqlalchemy.readthedocs.io/en/stable/models/#defining-models
@@ -51,6 +59,6 @@ class RecoveryCode(db.Model):
     __tablename__ = 'recovery_codes'
     
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False, index=True)
     code_hash = db.Column(db.String(64), nullable=False)
-    created_at = db.Column(db.DateTime, default=datetime.now(timezone.utc))
\ No newline at end of file
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
\ No newline at end of file
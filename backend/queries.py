@@ -0,0 +1,31 @@
+from sqlalchemy import select, lambda_stmt
+from models import db, User, Credential, RecoveryCode
+
+# Hot lookups as lambda statements
+# SQLAlchemy caches both the constructed statement and its compiled SQL, keyed on the
+# lambda's code, so repeated calls only bind new parameter values
+# https://docs.sqlalchemy.org/en/20/core/connections.html#using-lambdas-to-add-significant-speed-gains-to-statement-production
+
+
+# username lookup within a tenant, used by nearly every endpoint
+def user_by_username(username, tenant_id):
+    stmt = lambda_stmt(
+        lambda: select(User).where(User.tenant_id == tenant_id, User.username == username).limit(1)
+    )
+    return db.session.execute(stmt).scalars().first()
+
+
+# passkey by its row id, scoped to its owner
+def credential_for_user(passkey_id, user_id):
+    stmt = lambda_stmt(
+        lambda: select(Credential).where(Credential.id == passkey_id, Credential.user_id == user_id).limit(1)
+    )
+    return db.session.execute(stmt).scalars().first()
+
+
+# recovery code by its hash
+def recovery_code(user_id, code_hash):
+    stmt = lambda_stmt(
+        lambda: select(RecoveryCode).where(RecoveryCode.user_id == user_id, RecoveryCode.code_hash == code_hash).limit(1)
+    )
+    return db.session.execute(stmt).scalars().first()
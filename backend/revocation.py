@@ -0,0 +1,105 @@
+import os
+from sqlalchemy import select, delete, func
+from models import db, User, Credential, RecoveryCode
+import stats
+import versioning
+import sessions
+
+# Bulk revocation for incident response
+# rows are removed with set-based DELETE ... WHERE id IN (...) statements, the database's
+# ON DELETE CASCADE foreign keys take the credentials and recovery codes of deleted users
+# with them, nothing is loaded into the ORM session
+# the work is split into batches of REVOKE_BATCH_SIZE rows, each committed on its own,
+# so locks are only held for one batch and logins carry on while thousands of rows go
+# https://www.postgresql.org/docs/current/ddl-constraints.html#DDL-CONSTRAINTS-FK
+BATCH_SIZE = int(os.environ.get("REVOKE_BATCH_SIZE", 500))
+
+
+def chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+# after a batch is committed, take its credentials off the fleet stats, change the
+# ETags of the affected users and end their sessions, a few round trips per batch
+def invalidate(redis_client, usernames, field_counts, users_removed=0):
+    stats.record_counts(redis_client, field_counts, -1, users_delta=-users_removed)
+    versioning.bump_many(redis_client, usernames)
+    sessions.revoke_users_sessions(redis_client, usernames)
+
+
+# removes whole accounts, returns the counts and the usernames that did not exist
+# usernames must be a list, a single string would otherwise be read as its characters
+def revoke_users(redis_client, tenant_id, usernames, batch_size=BATCH_SIZE):
+    if not isinstance(usernames, list) or not all(isinstance(username, str) for username in usernames):
+        raise ValueError("usernames must be a list of strings")
+    result = {"users": 0, "credentials": 0, "recovery_codes": 0, "batches": 0, "not_found": []}
+    for batch in chunks(list(dict.fromkeys(usernames)), batch_size):
+        rows = db.session.execute(
+            select(User.id, User.username).where(User.tenant_id == tenant_id, User.username.in_(batch))
+        ).all()
+        found = {username: user_id for user_id, username in rows}
+        result["not_found"].extend(username for username in batch if username not in found)
+        if not found:
+            continue
+
+        user_ids = list(found.values())
+        # counted in the same transaction as the delete
+        field_counts = stats.count_fields(Credential.user_id.in_(user_ids))
+        codes = db.session.scalar(select(func.count(RecoveryCode.id)).where(RecoveryCode.user_id.in_(user_ids)))
+        db.session.execute(delete(User).where(User.id.in_(user_ids)))
+        db.session.commit()
+
+        invalidate(redis_client, list(found), field_counts, users_removed=len(user_ids))
+        result["users"] += len(user_ids)
+        result["credentials"] += field_counts.get("credentials", 0)
+        result["recovery_codes"] += codes or 0
+        result["batches"] += 1
+        print(f"Revoked {len(user_ids)} users in batch {result['batches']}")
+    return result
+
+
+# removes credentials by authenticator model (AAGUID) and / or registration date,
+# registered_from is inclusive and registered_to exclusive
+# users keep their account and recovery codes, so they can recover and register again
+def revoke_credentials(redis_client, tenant_id, aaguid=None, registered_from=None, registered_to=None,
+                       batch_size=BATCH_SIZE):
+    conditions = [User.tenant_id == tenant_id]
+    if aaguid is not None:
+        conditions.append(Credential.aaguid == aaguid)
+    if registered_from is not None:
+        conditions.append(Credential.created_at >= registered_from)
+    if registered_to is not None:
+        conditions.append(Credential.created_at < registered_to)
+    if len(conditions) == 1:
+        raise ValueError("an aaguid or a registration date range is required")
+
+    result = {"credentials": 0, "users_affected": 0, "batches": 0}
+    affected = set()
+    last_id = 0
+    while True:
+        # keyset pagination on the primary key, each batch starts where the last one stopped
+        rows = db.session.execute(
+            select(Credential.id, User.username)
+            .join(User)
+            .where(Credential.id > last_id, *conditions)
+            .order_by(Credential.id)
+            .limit(batch_size)
+        ).all()
+        if not rows:
+            break
+
+        credential_ids = [credential_id for credential_id, _ in rows]
+        usernames = list(dict.fromkeys(username for _, username in rows))
+        last_id = credential_ids[-1]
+        field_counts = stats.count_fields(Credential.id.in_(credential_ids))
+        db.session.execute(delete(Credential).where(Credential.id.in_(credential_ids)))
+        db.session.commit()
+
+        invalidate(redis_client, usernames, field_counts)
+        result["credentials"] += len(credential_ids)
+        affected.update(usernames)
+        result["batches"] += 1
+        print(f"Revoked {len(credential_ids)} credentials in batch {result['batches']}")
+    result["users_affected"] = len(affected)
+    return result
@@ -0,0 +1,251 @@
+import os
+import json
+import time
+import base64
+import hashlib
+import secrets
+from fido2.utils import websafe_decode, websafe_encode
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey, Ed25519PublicKey
+
+# Session tokens issued after a successful login
+# access tokens are short lived JWTs signed with Ed25519 (JWS alg "EdDSA") so other services
+# can verify them locally against the JWKS, refresh tokens are opaque, stored in redis and
+# rotated on every use
+# https://datatracker.ietf.org/doc/html/rfc7519 (JWT)
+# https://datatracker.ietf.org/doc/html/rfc8037 (EdDSA / OKP keys for JOSE)
+ISSUER = os.environ.get("SESSION_ISSUER", "passwordless-auth-system")
+ACCESS_TTL = int(os.environ.get("SESSION_ACCESS_TTL", 300))
+REFRESH_TTL = int(os.environ.get("SESSION_REFRESH_TTL", 14 * 24 * 3600))
+
+REFRESH_PREFIX = "session:refresh"    # hash of refresh token -> {username, family}
+USED_PREFIX = "session:used"          # hash of a rotated refresh token -> family, for reuse detection
+FAMILY_PREFIX = "session:family"      # family id -> username, the family is live while this exists
+USER_FAMILIES_PREFIX = "session:user" # username -> set of family ids
+REVOKED_JTI_KEY = "session:revoked"   # sorted set of revoked access token ids, scored by expiry
+REVOKED_USERS_KEY = "session:revoked_users"  # username -> time, tokens issued before it are invalid
+
+
+# signing keys come from SESSION_SIGNING_KEYS="kid:base64(32 byte seed),kid:..."
+# the first key signs, all of them are published in the JWKS so a key can be rotated
+# by putting a new one first and removing the old one once its tokens have expired
+def load_keys():
+    keys = {}
+    active = None
+    for entry in os.environ.get("SESSION_SIGNING_KEYS", "").split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        kid, _, encoded = entry.partition(":")
+        keys[kid] = Ed25519PrivateKey.from_private_bytes(base64.b64decode(encoded))
+        active = active or kid
+
+    if not keys:
+        # fine for a single process, several workers need the same keys in the environment
+        print("SESSION_SIGNING_KEYS is not set, using a random signing key for this process")
+        active = "local"
+        keys[active] = Ed25519PrivateKey.generate()
+    return active, keys
+
+ACTIVE_KID, SIGNING_KEYS = load_keys()
+
+
+def encode_segment(data):
+    return websafe_encode(json.dumps(data, separators=(",", ":")).encode())
+
+def token_hash(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+# public keys in JWK format
+# https://datatracker.ietf.org/doc/html/rfc8037#section-2
+def jwks():
+    keys = []
+    for kid, private_key in SIGNING_KEYS.items():
+        raw = private_key.public_key().public_bytes(
+            serialization.Encoding.Raw, serialization.PublicFormat.Raw
+        )
+        keys.append({"kty": "OKP", "crv": "Ed25519", "x": websafe_encode(raw), "kid": kid, "use": "sig", "alg": "EdDSA"})
+    return {"keys": keys}
+
+
+# audience is the tenant's RP ID, so a token from one tenant is not accepted by another's services
+def sign_access_token(username, now=None, audience=None):
+    now = int(now or time.time())
+    header = {"alg": "EdDSA", "typ": "JWT", "kid": ACTIVE_KID}
+    claims = {
+        "iss": ISSUER,
+        "sub": username,
+        "iat": now,
+        "exp": now + ACCESS_TTL,
+        "jti": secrets.token_urlsafe(12),
+    }
+    if audience:
+        claims["aud"] = audience
+    signing_input = f"{encode_segment(header)}.{encode_segment(claims)}"
+    signature = SIGNING_KEYS[ACTIVE_KID].sign(signing_input.encode())
+    return f"{signing_input}.{websafe_encode(signature)}"
+
+
+# store a new refresh token in an existing or new family
+def new_refresh_token(redis_client, username, family=None):
+    family = family or secrets.token_urlsafe(12)
+    token = secrets.token_urlsafe(32)
+    pipe = redis_client.pipeline()
+    pipe.setex(f"{REFRESH_PREFIX}:{token_hash(token)}", REFRESH_TTL, json.dumps({"username": username, "family": family}))
+    pipe.setex(f"{FAMILY_PREFIX}:{family}", REFRESH_TTL, username)
+    pipe.sadd(f"{USER_FAMILIES_PREFIX}:{username}", family)
+    pipe.expire(f"{USER_FAMILIES_PREFIX}:{username}", REFRESH_TTL)
+    pipe.execute()
+    return token
+
+
+def session_response(access_token, refresh_token):
+    return {
+        "access_token": access_token,
+        "token_type": "Bearer",
+        "expires_in": ACCESS_TTL,
+        "refresh_token": refresh_token,
+    }
+
+
+# called by the login endpoints
+def issue_session(redis_client, username, audience=None):
+    return session_response(sign_access_token(username, audience=audience), new_refresh_token(redis_client, username))
+
+
+def revoke_family(redis_client, family):
+    username = redis_client.get(f"{FAMILY_PREFIX}:{family}")
+    pipe = redis_client.pipeline()
+    pipe.delete(f"{FAMILY_PREFIX}:{family}")
+    if username:
+        pipe.srem(f"{USER_FAMILIES_PREFIX}:{username.decode()}", family)
+    pipe.execute()
+
+
+# rotate a refresh token, returns a new session or None
+# presenting a token that was already rotated revokes its whole family,
+# as it means the token was copied
+# https://datatracker.ietf.org/doc/html/draft-ietf-oauth-security-topics#name-refresh-token-protection
+def refresh_session(redis_client, refresh_token, audience=None):
+    hashed = token_hash(refresh_token)
+    record = redis_client.getdel(f"{REFRESH_PREFIX}:{hashed}")
+    if record is None:
+        reused_family = redis_client.get(f"{USED_PREFIX}:{hashed}")
+        if reused_family:
+            print("WARNING: refresh token reuse detected, revoking the session family")
+            revoke_family(redis_client, reused_family.decode())
+        return None
+
+    record = json.loads(record)
+    if not redis_client.exists(f"{FAMILY_PREFIX}:{record['family']}"):
+        return None
+    redis_client.setex(f"{USED_PREFIX}:{hashed}", REFRESH_TTL, record["family"])
+    return session_response(
+        sign_access_token(record["username"], audience=audience),
+        new_refresh_token(redis_client, record["username"], record["family"]),
+    )
+
+
+# logout, revokes the refresh token's family and optionally the access token itself
+def revoke_session(redis_client, refresh_token=None, access_token=None):
+    if refresh_token:
+        record = redis_client.getdel(f"{REFRESH_PREFIX}:{token_hash(refresh_token)}")
+        if record:
+            revoke_family(redis_client, json.loads(record)["family"])
+    if access_token:
+        claims = read_claims(access_token)
+        if claims:
+            redis_client.zadd(REVOKED_JTI_KEY, {claims["jti"]: claims["exp"]})
+
+
+# used when an account is revoked, kills every refresh family and
+# every access token issued to the user so far
+def revoke_user_sessions(redis_client, username):
+    revoke_users_sessions(redis_client, [username])
+
+
+# same for many users in two round trips, used by bulk revocation
+def revoke_users_sessions(redis_client, usernames):
+    if not usernames:
+        return
+    pipe = redis_client.pipeline()
+    for username in usernames:
+        pipe.smembers(f"{USER_FAMILIES_PREFIX}:{username}")
+    families_per_user = pipe.execute()
+
+    now = int(time.time())
+    pipe = redis_client.pipeline()
+    for username, families in zip(usernames, families_per_user):
+        for family in families:
+            pipe.delete(f"{FAMILY_PREFIX}:{family.decode()}")
+        pipe.delete(f"{USER_FAMILIES_PREFIX}:{username}")
+    pipe.hset(REVOKED_USERS_KEY, mapping={username: now for username in usernames})
+    pipe.execute()
+
+
+# revocation list for resource servers, drops entries whose tokens have expired anyway
+def revocation_list(redis_client):
+    now = int(time.time())
+    redis_client.zremrangebyscore(REVOKED_JTI_KEY, 0, now)
+    jtis = [jti.decode() for jti in redis_client.zrange(REVOKED_JTI_KEY, 0, -1)]
+
+    users = {}
+    expired = []
+    for name, at in redis_client.hgetall(REVOKED_USERS_KEY).items():
+        # every access token issued before this point has expired
+        if int(at) + ACCESS_TTL < now:
+            expired.append(name)
+        else:
+            users[name.decode()] = int(at)
+    if expired:
+        redis_client.hdel(REVOKED_USERS_KEY, *expired)
+    return {"jti": jtis, "users": users, "generated_at": now}
+
+
+# claims of a token signed by one of our keys, without revocation checks
+def read_claims(token):
+    return SessionVerifier(jwks()).verify(token)
+
+
+# Local verification for resource servers
+# built from the JWKS (and optionally the revocation list) once, then every check is
+# a signature verification and a few comparisons, no network hop
+class SessionVerifier:
+    def __init__(self, jwks_document, issuer=ISSUER, revocations=None, audience=None):
+        self.issuer = issuer
+        self.audience = audience
+        self.keys = {}
+        for jwk in jwks_document["keys"]:
+            if jwk.get("kty") == "OKP" and jwk.get("crv") == "Ed25519":
+                self.keys[jwk["kid"]] = Ed25519PublicKey.from_public_bytes(websafe_decode(jwk["x"]))
+        self.update_revocations(revocations or {})
+
+    def update_revocations(self, revocations):
+        self.revoked_jtis = set(revocations.get("jti", []))
+        self.revoked_users = dict(revocations.get("users", {}))
+
+    # returns the claims, or None if the token is not valid
+    def verify(self, token, now=None):
+        try:
+            header_b64, claims_b64, signature_b64 = token.split(".")
+            header = json.loads(websafe_decode(header_b64))
+            key = self.keys.get(header.get("kid"))
+            if key is None or header.get("alg") != "EdDSA":
+                return None
+            key.verify(websafe_decode(signature_b64), f"{header_b64}.{claims_b64}".encode())
+            claims = json.loads(websafe_decode(claims_b64))
+        except Exception:
+            return None
+
+        now = now or time.time()
+        if claims.get("iss") != self.issuer or claims.get("exp", 0) <= now:
+            return None
+        if self.audience is not None and claims.get("aud") != self.audience:
+            return None
+        if claims.get("jti") in self.revoked_jtis:
+            return None
+        revoked_at = self.revoked_users.get(claims.get("sub"))
+        if revoked_at is not None and claims.get("iat", 0) <= revoked_at:
+            return None
+        return claims
@@ -0,0 +1,164 @@
+from sqlalchemy import func
+from models import db, User, Credential
+
+# Fleet statistics kept as counters in a redis hash
+# https://redis.io/docs/latest/develop/data-types/hashes/
+# each field is "<dimension>:<value>" e.g. "fmt:packed" or "backup:synced",
+# so reading the whole summary is a single HGETALL no matter how many credentials exist
+STATS_KEY = "stats:fleet"
+
+# field set by rebuild_stats, marks a hash whose counters started from the database
+SEEDED = "seeded"
+
+# the dimensions that are counted for every credential
+DIMENSIONS = ("fmt", "trust", "aaguid", "backup", "type")
+
+
+# synced vs device-bound, same rules as is_backup_eligible in app.py
+# https://www.w3.org/TR/webauthn-3/#authdata-flags
+def backup_status(backup_eligible, backup_state):
+    if backup_eligible and backup_state:
+        return "synced"
+    elif backup_eligible:
+        return "eligible"
+    return "device-bound"
+
+
+# the hash fields a single credential contributes to
+def credential_fields(cred):
+    return fields_for(cred.attestation_fmt, cred.trust_level, cred.aaguid,
+                      cred.backup_eligible, cred.backup_state, cred.authenticator_type)
+
+def fields_for(fmt, trust, aaguid, backup_eligible, backup_state, authenticator_type):
+    return [
+        "credentials",
+        f"fmt:{fmt or 'unknown'}",
+        f"trust:{trust or 'unknown'}",
+        f"aaguid:{aaguid or 'unknown'}",
+        f"backup:{backup_status(backup_eligible, backup_state)}",
+        f"type:{authenticator_type or 'unknown'}",
+    ]
+
+
+# field totals for the credentials matching a filter, counted by the database with one
+# GROUP BY over the columns the counters use, so bulk deletes do not load the rows
+def count_fields(credential_filter):
+    columns = (Credential.attestation_fmt, Credential.trust_level, Credential.aaguid,
+               Credential.backup_eligible, Credential.backup_state, Credential.authenticator_type)
+    counts = {}
+    for *values, count in db.session.query(*columns, func.count(Credential.id)).filter(credential_filter).group_by(*columns):
+        for field in fields_for(*values):
+            counts[field] = counts.get(field, 0) + count
+    return counts
+
+
+# apply +1 / -1 for a list of credentials in one round trip
+# takes the output of credential_fields so it can be captured before a row is deleted
+def record_credentials(redis_client, fields_list, delta, users_delta=0):
+    counts = {}
+    for fields in fields_list:
+        for field in fields:
+            counts[field] = counts.get(field, 0) + 1
+    record_counts(redis_client, counts, delta, users_delta=users_delta)
+
+
+# same with field totals from count_fields, one HINCRBY per field
+# HINCRBY creates the hash when it is missing (redis restarted or flushed, or a write that
+# lands before the warm-up seeded it), so the counters are only trusted while the SEEDED
+# field written by rebuild_stats is there, a hash without it is rebuilt on the next read
+# https://redis.io/docs/latest/commands/hincrby/
+def record_counts(redis_client, counts, delta, users_delta=0):
+    try:
+        pipe = redis_client.pipeline()
+        for field, count in counts.items():
+            pipe.hincrby(STATS_KEY, field, delta * count)
+        if users_delta:
+            pipe.hincrby(STATS_KEY, "users", users_delta)
+        pipe.execute()
+    except Exception as e:
+        # the database commit already happened, a missed update is fixed by rebuild_stats
+        print(f"Error updating fleet stats: {e}")
+
+
+# wrappers used by the endpoints after the database commit succeeds
+def credential_added(redis_client, fields, new_user=False):
+    record_credentials(redis_client, [fields], 1, users_delta=1 if new_user else 0)
+
+def credential_removed(redis_client, fields):
+    record_credentials(redis_client, [fields], -1)
+
+
+# read the summary back and group it by dimension
+def get_stats(redis_client):
+    raw = redis_client.hgetall(STATS_KEY)
+    summary = {"users": 0, "credentials": 0}
+    for dimension in DIMENSIONS:
+        summary[dimension] = {}
+
+    for field, count in raw.items():
+        field = field.decode() if isinstance(field, bytes) else field
+        count = int(count)
+        if field in ("users", "credentials"):
+            summary[field] = count
+            continue
+        dimension, _, value = field.partition(":")
+        # counters that dropped to zero are left out of the response
+        if dimension in summary and count > 0:
+            summary[dimension][value] = count
+    return summary
+
+
+# reconciliation job, rebuilds the counters from the credentials table
+# uses GROUP BY so the database does the counting rather than loading every row
+# https://docs.sqlalchemy.org/en/20/tutorial/data_select.html#aggregate-functions-with-group-by-having
+# counts one tenant's credentials, redis_client is that tenant's scoped client
+def rebuild_stats(redis_client, tenant_id):
+    def credentials(*columns):
+        return db.session.query(*columns).join(User).filter(User.tenant_id == tenant_id)
+
+    counts = {
+        "users": db.session.query(func.count(User.id)).filter(User.tenant_id == tenant_id).scalar() or 0,
+        "credentials": credentials(func.count(Credential.id)).scalar() or 0,
+    }
+    columns = {
+        "fmt": Credential.attestation_fmt,
+        "trust": Credential.trust_level,
+        "aaguid": Credential.aaguid,
+        "type": Credential.authenticator_type,
+    }
+    for dimension, column in columns.items():
+        for value, count in credentials(column, func.count(Credential.id)).group_by(column):
+            field = f"{dimension}:{value or 'unknown'}"
+            counts[field] = counts.get(field, 0) + count
+
+    backup_rows = credentials(
+        Credential.backup_eligible, Credential.backup_state, func.count(Credential.id)
+    ).group_by(Credential.backup_eligible, Credential.backup_state)
+    for eligible, state, count in backup_rows:
+        field = f"backup:{backup_status(eligible, state)}"
+        counts[field] = counts.get(field, 0) + count
+
+    # write into a temporary key and rename it so readers never see a half built hash
+    # https://redis.io/docs/latest/commands/rename/
+    # increments for changes committed after the queries above but before the rename go to
+    # the old hash and are overwritten, so a rebuild can miss the writes made while it runs,
+    # the queries are all done before the pipeline to keep that window to a few milliseconds
+    # per tenant, run the rebuild again if the counters must be exact after a busy period
+    counts[SEEDED] = 1
+    tmp_key = f"{STATS_KEY}:rebuild"
+    pipe = redis_client.pipeline()
+    pipe.delete(tmp_key)
+    pipe.hset(tmp_key, mapping=counts)
+    pipe.rename(tmp_key, STATS_KEY)
+    pipe.execute()
+    print(f"Rebuilt fleet stats for {tenant_id}: {counts['users']} users, {counts['credentials']} credentials")
+    return get_stats(redis_client)
+
+
+# seeds the counters from the database when the hash was not built by rebuild_stats, e.g. on
+# the first deploy against an existing fleet or after redis lost its data, otherwise the
+# counters would only reflect changes made since then and could go negative
+# checks SEEDED rather than the key, increments recreate the key without it
+def ensure_stats(redis_client, tenant_id):
+    if not redis_client.hexists(STATS_KEY, SEEDED):
+        rebuild_stats(redis_client, tenant_id)
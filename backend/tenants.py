@@ -0,0 +1,232 @@
+import os
+import json
+import time
+import threading
+from fido2.rpid import verify_rp_id
+from fido2.webauthn import PublicKeyCredentialRpEntity
+
+# Tenant registry, one backend serving several relying parties
+# each tenant has its own RP ID, allowed origins, attestation conveyance and MDS policy,
+# a Fido2Server built once and cached, its own users (users.tenant_id) and its own redis keyspace
+# requests are matched by their Origin header, or by Host when there is no Origin,
+# using dictionaries built when the config is loaded, so a lookup costs the same for 1 or 1000 tenants
+# https://www.w3.org/TR/webauthn-3/#relying-party-identifier
+#
+# TENANTS_FILE is a JSON file, re-read when its modification time changes:
+# {
+#   "default": "default",
+#   "tenants": {
+#     "default": {
+#       "rp_id": "stephens-macbook-pro.local",
+#       "origins": ["https://stephens-macbook-pro.local:5173"]
+#     },
+#     "acme": {
+#       "rp_id": "login.acme.com",
+#       "rp_name": "Acme",
+#       "origins": ["https://login.acme.com", "https://acme.com"],
+#       "webauthn_origins": ["https://login.acme.com"],
+#       "hosts": ["api.acme.com"],
+#       "attestation": "direct",
+#       "mds": "record"
+#     }
+#   }
+# }
+# "default" (optional) is used for requests that match no tenant, without it they get 421
+# users created before tenants belong to the tenant with id "default", keep one with that id
+# or move them with python migrate.py --existing-tenant <id>, migrate refuses to run otherwise
+# origins are the CORS origins used to route requests, they do not decide which origins a
+# credential can be used from: WebAuthn ceremonies always need an https origin on the RP ID
+# or a subdomain of it (fido2's own check), webauthn_origins (optional) narrows that further
+# attestation is the conveyance preference: none, indirect, direct or enterprise
+# mds is "off", "record" (store whether metadata was available, the original behaviour)
+# or "enforce" (registrations must verify against the FIDO metadata service, and get a 503
+# while the metadata cannot be downloaded, logins do not need it)
+DEFAULT_TENANT = "default"
+MDS_POLICIES = ("off", "record", "enforce")
+
+# how often the file's modification time is checked, in seconds
+RELOAD_INTERVAL = float(os.environ.get("TENANTS_RELOAD_INTERVAL", 5))
+
+# the single relying party used when TENANTS_FILE is not set
+BUILTIN_CONFIG = {
+    "default": DEFAULT_TENANT,
+    "tenants": {
+        DEFAULT_TENANT: {
+            "rp_id": "stephens-macbook-pro.local",
+            "rp_name": "Passwordless authentication",
+            "origins": [
+                "http://localhost:5173",
+                "https://localhost:5173",
+                "https://192.168.1.157:5173",
+                "https://stephens-macbook-pro.local:5173",
+            ],
+            "attestation": "direct",
+            "mds": "record",
+        },
+    },
+}
+
+
+# redis commands whose first argument is a key, and those where every argument is a key
+SINGLE_KEY_COMMANDS = {
+    "get", "set", "setex", "setnx", "getdel", "incr", "expire",
+    "hincrby", "hgetall", "hexists", "hset", "hdel",
+    "sadd", "srem", "smembers",
+    "zadd", "zrange", "zremrangebyscore",
+}
+MULTI_KEY_COMMANDS = {"delete", "exists", "rename"}
+UNSCOPED_COMMANDS = {"ping", "execute"}
+
+
+# redis client (or pipeline) that puts the tenant prefix in front of every key
+# commands that are not listed above raise, so a new call site cannot silently
+# read or write another tenant's keys
+class ScopedRedis:
+    def __init__(self, client, prefix):
+        self._client = client
+        self._prefix = prefix
+
+    def pipeline(self, *args, **kwargs):
+        return ScopedRedis(self._client.pipeline(*args, **kwargs), self._prefix)
+
+    def __getattr__(self, name):
+        command = getattr(self._client, name)
+        prefix = self._prefix
+        if name in SINGLE_KEY_COMMANDS:
+            return lambda key, *args, **kwargs: command(prefix + key, *args, **kwargs)
+        if name in MULTI_KEY_COMMANDS:
+            return lambda *keys, **kwargs: command(*(prefix + key for key in keys), **kwargs)
+        if name in UNSCOPED_COMMANDS:
+            return command
+        raise AttributeError(f"redis command {name} is not tenant scoped")
+
+
+class Tenant:
+    def __init__(self, tenant_id, config):
+        self.id = tenant_id
+        self.config = config
+        self.rp_id = config["rp_id"]
+        self.rp_name = config.get("rp_name", self.rp_id)
+        self.origins = frozenset(config.get("origins", []))
+        webauthn_origins = config.get("webauthn_origins")
+        self.webauthn_origins = frozenset(webauthn_origins) if webauthn_origins is not None else None
+        self.hosts = frozenset(config.get("hosts", [])) | {self.rp_id}
+        self.attestation = config.get("attestation", "none")
+        self.mds = config.get("mds", "record")
+        if self.mds not in MDS_POLICIES:
+            raise ValueError(f"tenant {tenant_id}: mds must be one of {', '.join(MDS_POLICIES)}")
+        if not self.origins:
+            raise ValueError(f"tenant {tenant_id}: at least one origin is required")
+
+        # the default tenant keeps the unprefixed keys that existed before tenants
+        self.prefix = "" if tenant_id == DEFAULT_TENANT else f"tenant:{tenant_id}:"
+        self._server = None
+        self._lock = threading.Lock()
+
+    # fido2's default check (https, host is the RP ID or a subdomain), plus the tenant's
+    # webauthn_origins when it lists them
+    # https://www.w3.org/TR/webauthn-3/#sctn-validating-origin
+    def verify_origin(self, origin):
+        if not verify_rp_id(self.rp_id, origin):
+            return False
+        return self.webauthn_origins is None or origin in self.webauthn_origins
+
+    # built on first use and kept until the tenant's config changes
+    # the MDS policy is applied by register_finish, so login works without the metadata
+    def server(self):
+        if self._server is None:
+            with self._lock:
+                if self._server is None:
+                    from fido2.server import Fido2Server
+                    self._server = Fido2Server(
+                        PublicKeyCredentialRpEntity(id=self.rp_id, name=self.rp_name),
+                        attestation=self.attestation,
+                        verify_origin=self.verify_origin,
+                    )
+        return self._server
+
+    def redis(self, client):
+        return ScopedRedis(client, self.prefix) if self.prefix else client
+
+
+# immutable view of one version of the config, swapped as a whole on reload
+# so a request never sees half of an old config and half of a new one
+class Snapshot:
+    def __init__(self, config, previous=None):
+        self.tenants = {}
+        for tenant_id, tenant_config in config["tenants"].items():
+            old = previous.tenants.get(tenant_id) if previous else None
+            # an unchanged tenant keeps its Fido2Server
+            if old is not None and old.config == tenant_config:
+                self.tenants[tenant_id] = old
+            else:
+                self.tenants[tenant_id] = Tenant(tenant_id, tenant_config)
+
+        self.by_origin = {}
+        self.by_host = {}
+        for tenant in self.tenants.values():
+            for origin in tenant.origins:
+                claim(self.by_origin, origin, tenant, "origin")
+            for host in tenant.hosts:
+                claim(self.by_host, host, tenant, "host")
+
+        default = config.get("default")
+        if default is not None and default not in self.tenants:
+            raise ValueError(f"default tenant {default} is not defined")
+        self.default = self.tenants.get(default)
+
+
+# an origin or host can only belong to one tenant
+def claim(index, value, tenant, kind):
+    owner = index.get(value)
+    if owner is not None and owner is not tenant:
+        raise ValueError(f"{kind} {value} is used by both {owner.id} and {tenant.id}")
+    index[value] = tenant
+
+
+class TenantRegistry:
+    def __init__(self, path=None):
+        self.path = path
+        self.mtime = None
+        self.checked = 0.0
+        self.lock = threading.Lock()
+        self.snapshot = Snapshot(self.read() if path else BUILTIN_CONFIG)
+
+    def read(self):
+        self.mtime = os.stat(self.path).st_mtime_ns
+        with open(self.path) as f:
+            return json.load(f)
+
+    # hot reload, stats the file at most once per RELOAD_INTERVAL
+    # a config that fails to load is reported and the current one stays in use
+    def reload_if_changed(self):
+        if not self.path or time.monotonic() - self.checked < RELOAD_INTERVAL:
+            return
+        if not self.lock.acquire(blocking=False):
+            return
+        try:
+            self.checked = time.monotonic()
+            if os.stat(self.path).st_mtime_ns == self.mtime:
+                return
+            self.snapshot = Snapshot(self.read(), previous=self.snapshot)
+            print(f"Reloaded {len(self.snapshot.tenants)} tenants from {self.path}")
+        except Exception as e:
+            print(f"Error reloading tenants from {self.path}: {e}")
+        finally:
+            self.lock.release()
+
+    # the Origin header wins, Host is used for requests without one (curl, server to server)
+    def resolve(self, origin, host):
+        self.reload_if_changed()
+        snapshot = self.snapshot
+        tenant = snapshot.by_origin.get(origin) if origin else None
+        if tenant is None and host:
+            # drop the port, "[::1]" style IPv6 hosts without one are left alone
+            tenant = snapshot.by_host.get(host if host.endswith("]") else host.rsplit(":", 1)[0])
+        return tenant or snapshot.default
+
+    def all(self):
+        return list(self.snapshot.tenants.values())
+
+    def get(self, tenant_id):
+        return self.snapshot.tenants.get(tenant_id)
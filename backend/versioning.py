@@ -0,0 +1,50 @@
+import hashlib
+import secrets
+
+# Version counters for ETag / conditional GET support
+# https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/ETag
+# every mutation bumps the per-user credential-set version and the global
+# users/credentials version, the read endpoints turn those numbers into ETags
+# so an unchanged resource can be answered with 304 without querying postgres
+EPOCH_KEY = "version:epoch"
+GLOBAL_KEY = "version:users"
+
+def user_key(username):
+    return f"version:user:{username}"
+
+
+# random epoch so the ETags change if redis is flushed and the counters restart at 0
+# https://redis.io/docs/latest/commands/setnx/
+def get_epoch(redis_client):
+    epoch = redis_client.get(EPOCH_KEY)
+    if epoch is None:
+        redis_client.setnx(EPOCH_KEY, secrets.token_hex(8))
+        epoch = redis_client.get(EPOCH_KEY)
+    return epoch.decode() if isinstance(epoch, bytes) else epoch
+
+
+# called after a successful commit that changed a user's credentials
+# https://redis.io/docs/latest/commands/incr/
+def bump(redis_client, username=None):
+    bump_many(redis_client, [username] if username is not None else [])
+
+
+# same for any number of users in one round trip, used by bulk revocation
+def bump_many(redis_client, usernames):
+    try:
+        pipe = redis_client.pipeline()
+        for username in usernames:
+            pipe.incr(user_key(username))
+        pipe.incr(GLOBAL_KEY)
+        pipe.execute()
+    except Exception as e:
+        print(f"Error bumping versions: {e}")
+
+
+# strong ETag for a resource, scope keeps the different endpoints apart
+# user scoped resources use the per-user version, admin ones the global version
+def make_etag(redis_client, scope, username=None):
+    epoch = get_epoch(redis_client)
+    key = user_key(username) if username is not None else GLOBAL_KEY
+    version = int(redis_client.get(key) or 0)
+    return hashlib.sha256(f"{epoch}:{scope}:{username}:{version}".encode()).hexdigest()[:32]
@@ -0,0 +1,65 @@
+from fido2.utils import websafe_decode
+from fido2.webauthn import (
+    AttestationObject,
+    AuthenticatorData,
+    CollectedClientData,
+    RegistrationResponse,
+    AuthenticationResponse,
+    AuthenticatorAttestationResponse,
+    AuthenticatorAssertionResponse,
+    AuthenticationExtensionsClientOutputs,
+)
+
+# Single pass parsing of the client's WebAuthn payloads
+# each base64url field is decoded once and the CBOR / authenticator data is parsed once
+# into fido2's own types, the same objects are handed to Fido2Server for verification
+# (it accepts already built responses as-is) and read by clone detection, backup state
+# detection and attestation trust levels, so nothing is decoded a second time
+# https://www.w3.org/TR/webauthn-3/#sctn-authenticator-data
+# https://github.com/Yubico/python-fido2/blob/main/fido2/webauthn.py
+
+
+# everything register_finish needs from a registration response
+class ParsedRegistration:
+    def __init__(self, credential):
+        self.credential_id = websafe_decode(credential["rawId"])
+        attestation_object = AttestationObject(websafe_decode(credential["response"]["attestationObject"]))
+        self.response = RegistrationResponse(
+            raw_id=self.credential_id,
+            response=AuthenticatorAttestationResponse(
+                client_data=CollectedClientData(websafe_decode(credential["response"]["clientDataJSON"])),
+                attestation_object=attestation_object,
+            ),
+            authenticator_attachment=credential.get("authenticatorAttachment"),
+            client_extension_results=AuthenticationExtensionsClientOutputs(credential.get("clientExtensionResults") or {}),
+        )
+        self.fmt = attestation_object.fmt or "none"
+        self.auth_data = attestation_object.auth_data
+        self.flags = self.auth_data.flags
+        self.counter = self.auth_data.counter
+
+        credential_data = self.auth_data.credential_data
+        self.aaguid = credential_data.aaguid.hex() if credential_data and credential_data.aaguid else "unknown"
+
+
+# everything the login endpoints need from an assertion response
+class ParsedAssertion:
+    def __init__(self, credential):
+        self.credential_id = websafe_decode(credential["rawId"])
+        self.auth_data = AuthenticatorData(websafe_decode(credential["response"]["authenticatorData"]))
+        user_handle = credential["response"].get("userHandle")
+        self.user_handle = websafe_decode(user_handle) if user_handle else None
+        self.response = AuthenticationResponse(
+            raw_id=self.credential_id,
+            response=AuthenticatorAssertionResponse(
+                client_data=CollectedClientData(websafe_decode(credential["response"]["clientDataJSON"])),
+                authenticator_data=self.auth_data,
+                signature=websafe_decode(credential["response"]["signature"]),
+                user_handle=self.user_handle,
+            ),
+            authenticator_attachment=credential.get("authenticatorAttachment"),
+            client_extension_results=AuthenticationExtensionsClientOutputs(credential.get("clientExtensionResults") or {}),
+        )
+        self.flags = self.auth_data.flags
+        # the 32-bit signature counter (bytes 33-37 of the authenticator data)
+        self.counter = self.auth_data.counter
@@ -61,7 +61,7 @@ function App() {
       const finish_response = await fetch(`${API_BASE}/register/finish`, {
         method: "POST",
         headers: { "Content-Type": "application/json" },
-        body: JSON.stringify({ username, credential: credentials }),
+        body: JSON.stringify({ username, credential: credentials, challenge_token: options.challenge_token }),
       });
 
       // check if recovery codes are returned
@@ -203,7 +203,7 @@ function App() {
       await fetch(`${API_BASE}/login/finish`, {
         method: "POST",
         headers: { "Content-type": "application/json" },
-        body: JSON.stringify({ username, credential: assertion }),
+        body: JSON.stringify({ username, credential: assertion, challenge_token: options.challenge_token }),
       });
 
       addLog('Signature verified successfully', 'success')
@@ -246,7 +246,7 @@ function App() {
       const finishRes = await fetch(`${API_BASE}/login/finish/usernameless`, {
         method: "POST",
         headers: { "Content-type": "application/json" },
-        body: JSON.stringify({ credential: assertion }),
+        body: JSON.stringify({ credential: assertion, challenge_token: options.challenge_token }),
       });
 
       const result = await finishRes.json();
@@ -310,7 +310,7 @@ function App() {
         const finishRes = await fetch(`${API_BASE}/login/finish/usernameless`, {
           method: "POST",
           headers: { "Content-type": "application/json" },
-          body: JSON.stringify({ credential: assertion }),
+          body: JSON.stringify({ credential: assertion, challenge_token: options.challenge_token }),
         });
 
         const result = await finishRes.json();
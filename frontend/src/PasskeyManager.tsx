@@ -30,15 +30,12 @@ function PasskeyManager() {
         addLog('>>> FETCH PASSKEYS <<<', 'info')
         addLog(`User: ${username}`, 'info')        
         addLog('Connecting to API', 'info')
-        addLog('POST /user/passkeys', 'info')
+        addLog('GET /user/passkeys', 'info')
         addLog('Sending request...', 'waiting')
         
         try {
-            const response = await fetch(`${API_BASE}/user/passkeys`, {
-                method: "POST",
-                headers: { "Content-Type": "application/json" },
-                body: JSON.stringify({ username }),
-            })
+            // GET so the browser cache can revalidate with the ETag (If-None-Match -> 304)
+            const response = await fetch(`${API_BASE}/user/passkeys?username=${encodeURIComponent(username)}`)
 
             if (!response.ok){
                 addLog('Response: 404 Not Found', 'error')
@@ -117,7 +114,7 @@ function PasskeyManager() {
             const finishResponse = await fetch(`${API_BASE}/register/finish`, {
                 method: "POST",
                 headers: { "Content-Type": "application/json" },
-                body: JSON.stringify({ username, credential: attestation }),
+                body: JSON.stringify({ username, credential: attestation, challenge_token: options.challenge_token }),
             });
 
             // handle server response
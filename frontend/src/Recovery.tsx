@@ -79,7 +79,7 @@ function Recovery() {
       const finishResponse = await fetch(`${API_BASE}/register/finish`, {
         method: "POST",
         headers: { "Content-Type": "application/json" },
-        body: JSON.stringify({ username, credential: credentials }),
+        body: JSON.stringify({ username, credential: credentials, challenge_token: result.challenge_token }),
       });
 
       // Detailed logging of the registration process